@@ -1,9 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import datetime
+import fcntl
+import functools
 import logging
 import os
 import os.path
-from typing import List, Optional
+import subprocess
+import time
+from typing import Callable, ContextManager, Dict, List, Optional, Sequence
 
 import arrow
 import pkg_resources
@@ -12,21 +17,56 @@ from plumbum import (ProcessExecutionError,
                      local)
 from plumbum.cmd import (egrep,  # pylint: disable=import-error
                          ln,
+                         mkdir,
+                         mv,
                          rm,
                          sudo,
                          tar)
 
-from .chroot import Chroot
+from .cache import (ReleaseCache,
+                    default_cache_dir,
+                    make_cache_key)
+from .ccache import (CCACHE_DIR,
+                     make_ccache_env_vars,
+                     reporting_ccache_stats)
+from .chroot import (PORTAGE_TMPFS_DIR,
+                     Chroot,
+                     ChrootBatch,
+                     ChrootExec,
+                     PrivateChrootExec)
+from .decompress import (DECOMPRESSOR_CHOICES,
+                         find_decompressor)
 from .download import (Digests,
                        StageDownloader)
 from .exceptions import GeniException
+from .golden import (CLONE_MODES,
+                     ChrootClone,
+                     GoldenImages,
+                     clone_reflink)
 from .gpgaside import GpgAside
+from .install import InstallManifest, InstallPlan
+from .mirrors import (default_mirrors_file,
+                      load_mirrors,
+                      rank_mirrors)
 from .mount import (BindMount,
+                    Mount,
                     MountsManager,
-                    OverlayMount)
-from .util import (FileInstaller,
+                    OverlayMount,
+                    mounts_under)
+from .parallelism import (RAM_PER_JOB,
+                          Parallelism,
+                          compute_parallelism,
+                          set_make_conf_parallelism)
+from .shared import DISTDIR, PKGDIR, SharedCache
+from .steps import Step, run_steps
+from .transport import (Session,
+                        TransportConfig)
+from .util import (hash_path,
+                   join_url,
                    make_proxies_dict,
                    no_escaping,
+                   parse_size,
+                   sibling_path,
                    sudo_write)
 
 
@@ -36,6 +76,9 @@ AUTHOR_KEY_ID = "E420A389C19FB5B7"
 GENTOO_RELENG_KEY_ID = "BB572E0E2D182910"
 
 
+Action = Callable[[], None]
+
+
 class FileCorruptedError(GeniException):
     pass
 
@@ -48,30 +91,295 @@ def configure_net_simple_names(chroot_dir: str) -> None:
                          net_name_slot_rules_path.lstrip("/"))]]()
 
 
-def configure_time_zone(chroot: Chroot, timezone: str) -> None:
-    timezone_file_path = os.path.join(chroot.chroot_dir, "etc", "timezone")
+def configure_notmpfs_packages(chroot_dir: str,
+                               atoms: Sequence[str]) -> None:
+    """Adds packages to be built on disk instead of portage tmpfs, besides
+    the ones listed by bootstrap. Packages added before are kept.
+    """
+    package_env_dir = os.path.join(chroot_dir, "etc", "portage", "package.env")
+    if os.path.isfile(package_env_dir):
+        raise GeniException(f"{package_env_dir} is a file, not a directory")
+    local_path = os.path.join(package_env_dir, "geni-notmpfs-local")
+    try:
+        with open(local_path, "r") as local_file:
+            lines = local_file.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+
+    new_lines = [f"{atom} notmpfs.conf" for atom in atoms]
+    lines.extend(line
+                 for line in dict.fromkeys(new_lines)
+                 if line not in lines)
+    sudo[mkdir["-p", package_env_dir]]()
+    sudo_write(local_path, "".join(f"{line}\n" for line in lines))
+
+
+def configure_time_zone(chroot_dir: str,
+                        chroot_exec: ChrootExec,
+                        timezone: str) -> None:
+    timezone_file_path = os.path.join(chroot_dir, "etc", "timezone")
     sudo_write(timezone_file_path, timezone + "\n")
+    chroot_exec("emerge", "--config", "sys-libs/timezone-data")
+
+
+def log_throughput(action: str, size: int, start_time: float) -> None:
+    elapsed = max(time.monotonic() - start_time, 1e-6)
+    logging.info("%s %.1f MiB in %.1f s (%.1f MiB/s)",
+                 action,
+                 size / 2**20,
+                 elapsed,
+                 size / 2**20 / elapsed)
+
+
+def make_tar_extract(archive_path: str,
+                     output_dir: str,
+                     compress_program: Optional[str]):
+    args = ["xpf",
+            archive_path,
+            "-C", output_dir,
+            "--xattrs-include='*.*'",
+            "--numeric-owner"]
+    if compress_program:
+        args.append(f"--use-compress-program={compress_program}")
+    else:
+        args[0] = "xapf"
+    return sudo[tar[args]]
 
-    with chroot as chroot_exec:
-        chroot_exec("emerge", "--config", "sys-libs/timezone-data")
+
+def ensure_nothing_mounted_under(path: str) -> None:
+    mount_points = mounts_under(path)
+    if mount_points:
+        raise GeniException(f"Refusing to remove {path}, file systems are "
+                            f"still mounted under it: "
+                            f"{', '.join(mount_points)}")
+
+
+def make_trash_path(path: str) -> str:
+    return sibling_path(path,
+                        lambda name: (f"._trash_{name}_{os.getpid()}_"
+                                      f"{int(time.time())}"))
+
+
+TRASH_LOG_SUFFIX = ".log"
+
+
+@functools.lru_cache(maxsize=None)
+def can_sudo_detached() -> bool:
+    """Tells whether sudo runs without password in a detached session.
+
+    Credentials cached for the terminal don't apply there, so it's checked
+    the same way the background remover is started.
+    """
+    checker = sudo["-n", "true"].popen(start_new_session=True,
+                                       stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+    return checker.wait() == 0
+
+
+def remove_now(path: str) -> None:
+    logging.info("Removing: %s", path)
+    try:
+        entries = os.listdir(path)
+    except PermissionError:
+        entries = []
+    remove_entries_in_parallel(path, entries)
+    sudo[rm["-rf", path, path + TRASH_LOG_SUFFIX]]()
+
+
+def remove_in_background(path: str) -> None:
+    """Removes `path` by detached process which outlives geni.
+
+    The process holds a lock on `path` while removing it, so
+    `sweep_trash` can tell whether it's still running. Its errors are
+    written into a log next to `path`, removed along with it on success.
+    sudo doesn't ask for password, as there's no one to answer, so `path`
+    is removed synchronously where sudo would need one.
+    """
+    if not can_sudo_detached():
+        remove_now(path)
+        return
+
+    logging.info("Removing in background: %s", path)
+    log_path = path + TRASH_LOG_SUFFIX
+    with open(log_path, "w") as log_file:
+        # Another process already removing it isn't an error.
+        sudo["-n", "flock", "--nonblock", "--conflict-exit-code", "0", path,
+             "sh", "-c", 'rm -rf -- "$1" && rm -f -- "$1.log"',
+             "geni-remove", path].popen(start_new_session=True,
+                                        stdin=subprocess.DEVNULL,
+                                        stdout=log_file,
+                                        stderr=log_file)
+
+
+def is_being_removed(path: str) -> bool:
+    """Tells whether `path` is locked by process removing it, or can't be
+    told as it's unreadable.
+    """
+    try:
+        dir_fd = os.open(path, os.O_RDONLY)
+    except (FileNotFoundError, PermissionError):
+        return True
+    try:
+        fcntl.flock(dir_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(dir_fd)
+    return False
 
 
-def extract_stage_tarball_into(archive_path: str, output_dir: str) -> None:
+def sweep_trash(path: str) -> None:
+    """Removes in background what's left of trash siblings of `path` which
+    failed to be removed or whose removal was killed, logging errors of
+    earlier attempts.
+    """
+    parent_dir, name = os.path.split(os.path.abspath(path))
+    prefix = f"._trash_{name}_"
+    for entry in os.listdir(parent_dir):
+        trash_path = os.path.join(parent_dir, entry)
+        if (not entry.startswith(prefix)
+                or entry.endswith(TRASH_LOG_SUFFIX)
+                or is_being_removed(trash_path)):
+            continue
+
+        try:
+            with open(trash_path + TRASH_LOG_SUFFIX, "r") as log_file:
+                errors = log_file.read().strip()
+        except FileNotFoundError:
+            errors = ""
+        if errors:
+            logging.warning("Failed to remove %s earlier: %s",
+                            trash_path, errors)
+        remove_in_background(trash_path)
+
+
+def remove_entries_in_parallel(path: str, entries: List[str]) -> None:
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = [pool.submit(sudo[rm["-rf", os.path.join(path, entry)]])
+                   for entry in entries]
+        for future in futures:
+            future.result()
+
+
+def clear_dir(output_dir: str) -> None:
+    """Removes content of `output_dir` without waiting for it to be deleted
+    where possible.
+
+    The directory is renamed aside and removed in background. If it is
+    a mount point, its entries are removed in parallel instead. Trash left
+    by earlier calls is swept.
+    """
+    ensure_nothing_mounted_under(output_dir)
+    sweep_trash(output_dir)
+    output_dir_listing = os.listdir(output_dir)
+    if not output_dir_listing:
+        return
+
+    logging.info("Output directory already exists, removing its content: %s",
+                 output_dir)
+    if os.path.ismount(output_dir):
+        remove_entries_in_parallel(output_dir, output_dir_listing)
+    else:
+        trash_dir = make_trash_path(output_dir)
+        sudo[mv["-T", output_dir, trash_dir]]()
+        os.makedirs(output_dir)
+        remove_in_background(trash_dir)
+
+
+def extract_stage_tarball_into(archive_path: str,
+                               output_dir: str,
+                               decompressor: str = "auto",
+                               discard_old: Optional[Action] = None) -> None:
     # TODO: check whether it's newer?
     # TODO: release in .extracted file?
-    output_dir_listing = os.listdir(output_dir)
-    if output_dir_listing:
-        logging.info("Output directory already exists, removing its content: "
-                     "%s", output_dir)
-        for file in output_dir_listing:
-            sudo[rm["-rf", os.path.join(output_dir, file)]]()
+    compress_program = find_decompressor(archive_path, decompressor)
+    if discard_old:
+        discard_old()
+    clear_dir(output_dir)
     os.makedirs(output_dir, exist_ok=True)
+    start_time = time.monotonic()
+    with no_escaping():
+        make_tar_extract(archive_path, output_dir, compress_program)()
+    log_throughput("Extracted", os.path.getsize(archive_path), start_time)
+
+
+def replace_dir(source_dir: str, target_dir: str) -> None:
+    """Replaces `target_dir` with `source_dir` by renaming.
+
+    Content is moved instead if `target_dir` is a mount point.
+    """
+    if os.path.ismount(target_dir):
+        clear_dir(target_dir)
+        sudo[mv["-t", target_dir,
+                [os.path.join(source_dir, entry)
+                 for entry in os.listdir(source_dir)]]]()
+        sudo[rm["-rf", source_dir]]()
+        return
+
+    old_dir = make_trash_path(target_dir)
+    if os.path.exists(target_dir):
+        ensure_nothing_mounted_under(target_dir)
+        sudo[mv["-T", target_dir, old_dir]]()
+    sudo[mv["-T", source_dir, target_dir]]()
+    if os.path.exists(old_dir):
+        remove_in_background(old_dir)
+
+
+def stream_stage_tarball_into(stage_downloader: StageDownloader,
+                              digests: Digests,
+                              release: str,
+                              output_dir: str,
+                              decompressor: str = "auto",
+                              discard_old: Optional[Action] = None) -> str:
+    """Extracts stage tarball while it's being downloaded.
+
+    Tarball is extracted into a staging directory which replaces
+    `output_dir` only if the downloaded tarball matches its digest.
+    `discard_old` is called just before that.
+    """
+    staging_dir = sibling_path(output_dir, "._staging_{}".format)
+    if os.path.exists(staging_dir):
+        sudo[rm["-rf", staging_dir]]()
+    os.makedirs(staging_dir)
+
+    compress_program = find_decompressor(release,
+                                         decompressor,
+                                         from_pipe=True)
+    start_time = time.monotonic()
     with no_escaping():
-        sudo[tar["xapf",
-                 archive_path,
-                 "-C", output_dir,
-                 "--xattrs-include='*.*'",
-                 "--numeric-owner"]]()
+        extractor = make_tar_extract("-", staging_dir, compress_program).popen(
+            stdin=subprocess.PIPE, stdout=None, stderr=None)
+    try:
+        stage_path = stage_downloader.download_stage(
+            release,
+            digests.hash_name,
+            consumers=[extractor.stdin.write])
+        extractor.stdin.close()
+        if extractor.wait() != 0:
+            raise GeniException(f"Failed to extract stage tarball into "
+                                f"{staging_dir}")
+        if not digests.verify(stage_path):
+            logging.fatal("Wrong check sum: %s", stage_path)
+            raise FileCorruptedError(stage_path)
+    except BaseException:
+        # Killing sudo would leave tar running as root, whereas closing its
+        # input makes it exit on truncated archive.
+        try:
+            extractor.stdin.close()
+        except BrokenPipeError:
+            pass
+        extractor.wait()
+        sudo[rm["-rf", staging_dir]]()
+        raise
+
+    log_throughput("Downloaded and extracted",
+                   os.path.getsize(stage_path),
+                   start_time)
+    if discard_old:
+        discard_old()
+    replace_dir(staging_dir, output_dir)
+    return stage_path
 
 
 def find_locale_line(chroot_dir: str, locale_name: str) -> str:
@@ -80,8 +388,10 @@ def find_locale_line(chroot_dir: str, locale_name: str) -> str:
     return egrep["-i", f"^{locale_name}\\s+"](supported_locale_file_path)
 
 
-def generate_locales(chroot: Chroot, locales: List[str]) -> None:
-    locale_file_path = os.path.join(chroot.chroot_dir, "etc", "locale.gen")
+def generate_locales(chroot_dir: str,
+                     chroot_exec: ChrootExec,
+                     locales: List[str]) -> None:
+    locale_file_path = os.path.join(chroot_dir, "etc", "locale.gen")
 
     with open(locale_file_path, "r") as file:
         locale_file_lines = file.readlines()
@@ -106,13 +416,11 @@ def generate_locales(chroot: Chroot, locales: List[str]) -> None:
 
     while remaining_locales:
         locale_name = remaining_locales[0]
-        modified_lines.append(find_locale_line(chroot.chroot_dir, locale_name))
+        modified_lines.append(find_locale_line(chroot_dir, locale_name))
         remaining_locales.remove(locale_name.lower())
 
     sudo_write(locale_file_path, "".join(modified_lines))
-
-    with chroot as chroot_exec:
-        chroot_exec.fg("locale-gen")
+    chroot_exec.fg("locale-gen")
 
 
 def make_chroot_dir(work_dir: str) -> str:
@@ -129,73 +437,185 @@ def make_work_dir() -> str:
     return work_dir
 
 
-def set_locale(chroot: Chroot, locale_name: str) -> None:
-    with chroot as chroot_exec:
-        chroot_exec("eselect", "locale", "set", locale_name)
+def set_locale(chroot_exec: ChrootExec, locale_name: str) -> None:
+    chroot_exec("eselect", "locale", "set", locale_name)
 
 
-def install_stage_tarball(gpg_aside: GpgAside,
-                          mirror_url: str,
-                          downloads_dir: str,
-                          chroot_dir: str) -> None:
-    stage_downloader = StageDownloader(mirror_url, downloads_dir)
-    latest_release = stage_downloader.find_latest()
+def find_cached_stage_tarball(release_cache: Optional[ReleaseCache],
+                              digests: Digests,
+                              stage_path: str) -> Optional[str]:
+    if release_cache is None:
+        return None
 
+    expected_hash = digests.expected_hash(stage_path)
+    cached_path = release_cache.get(digests.hash_name, expected_hash)
+    if cached_path and not digests.verify(cached_path, listed_as=stage_path):
+        logging.error("Wrong check sum, evicting from cache: %s", cached_path)
+        release_cache.remove(digests.hash_name, expected_hash)
+        return None
+    return cached_path
+
+
+def download_digests(gpg_aside: GpgAside,
+                     stage_downloader: StageDownloader,
+                     release: str) -> Digests:
     logging.info("Downloading digests")
-    digests_path = stage_downloader.download_digests(latest_release)
+    digests_path = stage_downloader.download_digests(release)
     if not gpg_aside.verify(digests_path):
         raise FileCorruptedError(digests_path)
-    digests = Digests(digests_path)
+    return Digests(digests_path)
+
+
+def extract_release_into(output_dir: str,
+                         stage_downloader: StageDownloader,
+                         digests: Digests,
+                         latest_release: str,
+                         release_cache: Optional[ReleaseCache] = None,
+                         stream_extract: bool = False,
+                         decompressor: str = "auto",
+                         discard_old: Optional[Action] = None) -> None:
+    """Extracts release into `output_dir`, calling `discard_old` once the
+    tarball is verified, right before content of `output_dir` is replaced.
+    """
+    stage_path = stage_downloader.local_path(latest_release)
+    cached_path = find_cached_stage_tarball(release_cache,
+                                            digests,
+                                            stage_path)
+    if cached_path:
+        logging.info("Extracting cached %s stage3 tarball", latest_release)
+        extract_stage_tarball_into(cached_path,
+                                   output_dir,
+                                   decompressor,
+                                   discard_old)
+        return
+
+    if stream_extract and not os.path.exists(stage_path):
+        logging.info("Downloading and extracting %s stage3 tarball",
+                     latest_release)
+        stream_stage_tarball_into(stage_downloader,
+                                  digests,
+                                  latest_release,
+                                  output_dir,
+                                  decompressor,
+                                  discard_old)
+    else:
+        logging.info("Downloading %s stage3 tarball", latest_release)
+        stage_downloader.download_stage(latest_release, digests.hash_name)
+        if not digests.verify(stage_path):
+            logging.fatal("Wrong check sum: %s", stage_path)
+            raise FileCorruptedError(stage_path)
 
-    logging.info("Downloading %s stage3 tarball", latest_release)
-    stage_path = stage_downloader.download_stage(latest_release)
-    if not digests.verify(stage_path):
-        logging.fatal("Wrong check sum: %s", stage_path)
-        raise FileCorruptedError(stage_path)
+        logging.info("Extracting %s stage3 tarball", latest_release)
+        extract_stage_tarball_into(stage_path,
+                                   output_dir,
+                                   decompressor,
+                                   discard_old)
 
-    logging.info("Extracting %s stage3 tarball", latest_release)
-    extract_stage_tarball_into(stage_path, chroot_dir)
+    if release_cache:
+        release_cache.add(stage_path,
+                          digests.hash_name,
+                          digests.expected_hash(stage_path),
+                          latest_release)
 
 
-def configure_portage_basic(chroot: Chroot) -> None:
+def install_stage_tarball(gpg_aside: GpgAside,
+                          stage_downloader: StageDownloader,
+                          chroot_dir: str,
+                          release_cache: Optional[ReleaseCache] = None,
+                          stream_extract: bool = False,
+                          decompressor: str = "auto",
+                          clone_mode: str = "extract",
+                          chroot_clone: Optional[ChrootClone] = None) -> None:
+    """Installs latest stage3 into `chroot_dir`.
+
+    Stage tarball is either extracted directly into the chroot or into
+    a golden tree kept per release, which the chroot is then cloned from.
+    Overlay of `chroot_clone` is discarded only once the new tree is
+    ready, so a failed download leaves the chroot as it was.
+    """
+    latest_release = stage_downloader.find_latest()
+    digests = download_digests(gpg_aside, stage_downloader, latest_release)
+    extract_into = functools.partial(extract_release_into,
+                                     stage_downloader=stage_downloader,
+                                     digests=digests,
+                                     latest_release=latest_release,
+                                     release_cache=release_cache,
+                                     stream_extract=stream_extract,
+                                     decompressor=decompressor)
+
+    if clone_mode == "extract":
+        discard_old = chroot_clone.discard if chroot_clone else None
+        extract_into(chroot_dir, discard_old=discard_old)
+        return
+
+    if release_cache is None or chroot_clone is None:
+        raise GeniException(f"Cloning chroot with {clone_mode} requires "
+                            f"stage3 cache")
+
+    stage_path = stage_downloader.local_path(latest_release)
+    key = make_cache_key(digests.hash_name, digests.expected_hash(stage_path))
+    golden_images = GoldenImages(release_cache.cache_dir)
+    with golden_images.ensure(key, extract_into) as golden_path:
+        logging.info("Cloning %s into %s", golden_path, chroot_dir)
+        chroot_clone.discard()
+        clear_dir(chroot_dir)
+        if clone_mode == "overlay":
+            chroot_clone.clone_overlay(golden_path)
+        else:
+            clone_reflink(golden_path, chroot_dir)
+
+
+def configure_portage_basic(chroot: Chroot,
+                            parallelism: Optional[Parallelism] = None) -> None:
     config_path = pkg_resources.resource_filename(
         __name__, "data/portage-basic")
-    finst = FileInstaller(config_path, chroot.chroot_dir)
-    finst.install(os.path.join("etc", "portage", "make.conf"),
-                  mode="0644")
-    finst.install(os.path.join("etc", "portage", "repos.conf", "gentoo.conf"),
-                  mode="0644")
-    finst.install(os.path.join("usr", "local", "portage", "metadata",
-                               "layout.conf"),
-                  mode="0644")
-    finst.install(os.path.join("usr", "local", "portage", "profiles",
-                               "repo_name"),
-                  mode="0644")
-    finst.install(os.path.join("var", "lib", "portage", "world"),
-                  mode="0644")
-
-    with chroot as chroot_exec:
-        portage_dir = chroot_exec(
-            "portageq", "get_repo_path", "/", "gentoo").strip()
-        chroot_exec("mkdir", "-p", portage_dir)
+    make_conf_path = os.path.join("etc", "portage", "make.conf")
+    with open(os.path.join(config_path, make_conf_path), "r") as make_conf:
+        make_conf_content = make_conf.read()
+    if parallelism is not None:
+        logging.info("Build parallelism: MAKEOPTS=\"%s\", emerge %s",
+                     parallelism.makeopts,
+                     " ".join(parallelism.emerge_opts))
+        make_conf_content = set_make_conf_parallelism(make_conf_content,
+                                                      parallelism)
+
+    plan = InstallPlan(config_path, chroot.chroot_dir)
+    plan.add(os.path.join("etc", "portage", "repos.conf", "gentoo.conf"),
+             mode=0o644)
+    plan.add(os.path.join("usr", "local", "portage", "metadata",
+                          "layout.conf"),
+             mode=0o644)
+    plan.add(os.path.join("usr", "local", "portage", "profiles",
+                          "repo_name"),
+             mode=0o644)
+    plan.add(os.path.join("var", "lib", "portage", "world"), mode=0o644)
+    plan.add(os.path.join("etc", "portage", "env", "notmpfs.conf"),
+             mode=0o644)
+    plan.add(os.path.join("etc", "portage", "package.env", "geni-notmpfs"),
+             mode=0o644)
+    plan.add(os.path.join("var", "tmp", "notmpfs", ".keep_geni"),
+             mode=0o644)
+    plan.apply()
+    sudo_write(os.path.join(chroot.chroot_dir, make_conf_path),
+               make_conf_content)
+
+    batch = chroot.batch()
+    batch.add_shell("repo dir",
+                    'mkdir -p "$(portageq get_repo_path / gentoo)"')
+    batch.run()
 
 
 def configure_portage_extras(chroot_dir: str) -> None:
     config_path = pkg_resources.resource_filename(
         __name__, "data/portage-extras")
-    finst = FileInstaller(config_path, chroot_dir)
-    finst.install(os.path.join("etc", "portage", "repo.postsync.d",
-                               "sync_gentoo_cache"),
-                  mode="0755")
-    finst.install(os.path.join("etc", "portage", "repo.postsync.d",
-                               "sync_gentoo_dtd"),
-                  mode="0755")
-    finst.install(os.path.join("etc", "portage", "repo.postsync.d",
-                               "sync_gentoo_glsa"),
-                  mode="0755")
-    finst.install(os.path.join("etc", "portage", "repo.postsync.d",
-                               "sync_gentoo_news"),
-                  mode="0755")
+    plan = InstallPlan(config_path, chroot_dir)
+    for hook in ["sync_gentoo_cache",
+                 "sync_gentoo_dtd",
+                 "sync_gentoo_glsa",
+                 "sync_gentoo_news"]:
+        plan.add(os.path.join("etc", "portage", "repo.postsync.d", hook),
+                 mode=0o755)
+    plan.apply()
 
 
 def get_portage_timestamp_file_path(chroot_dir: str) -> str:
@@ -233,24 +653,54 @@ def sync_repo(chroot: Chroot) -> None:
         logging.info("Portage tree is in sync.")
 
 
-def upgrade_system(chroot: Chroot) -> None:
-    with chroot as chroot_exec:
-        logging.info("Updating @world...")
-        chroot_exec.fg("emerge",
-                       "--autounmask-write",
-                       "--quiet-build=y",
-                       "-NuD",
-                       "@world")
+def queue_sync_repo(chroot_dir: str, batch: ChrootBatch) -> None:
+    """Queues the same as `sync_repo`. Whether the snapshot unpacked by
+    `emerge-webrsync` needs sync is checked in chroot, after it's unpacked.
+    """
+    if not check_portage_tree_exists(chroot_dir):
+        batch.add("emerge-webrsync",
+                  "emerge-webrsync",
+                  env_vars=make_proxies_dict())
+        timestamp_path = get_portage_timestamp_file_path("/")
+        sync_command = ChrootExec.make_command(["emerge", "--sync"],
+                                               make_proxies_dict())
+        batch.add_shell(
+            "sync",
+            f'last_sync="$(date -d "$(head -n 1 {timestamp_path})" +%s)" '
+            f'&& [ $(( $(date +%s) - last_sync )) -lt 86400 ] '
+            f'|| {sync_command}')
+    elif check_portage_needs_sync(chroot_dir):
+        batch.add("sync", "emerge", "--sync", env_vars=make_proxies_dict())
+    else:
+        logging.info("Portage tree is in sync.")
+
+
+def upgrade_system(batch: ChrootBatch,
+                   env_vars: Optional[Dict[str, str]] = None,
+                   emerge_opts: Sequence[str] = ()) -> None:
+    batch.add("upgrade",
+              "emerge",
+              "--autounmask-write",
+              "--quiet-build=y",
+              *emerge_opts,
+              "-NuD",
+              "@world",
+              env_vars=env_vars or {})
 
 
-def emerge(chroot: Chroot, packages: List[str]) -> None:
+def emerge(chroot: Chroot,
+           packages: List[str],
+           env_vars: Optional[Dict[str, str]] = None,
+           emerge_opts: Sequence[str] = ()) -> None:
     assert not any([p.startswith("-") for p in packages])
 
     with chroot as chroot_exec:
         chroot_exec.fg("emerge",
                        "--autounmask-write",
                        "--quiet-build=y",
-                       *packages)
+                       *emerge_opts,
+                       *packages,
+                       env_vars=env_vars or {})
 
 
 def clean_distdir(chroot: Chroot) -> None:
@@ -261,12 +711,58 @@ def clean_distdir(chroot: Chroot) -> None:
 
 class Geni(cli.Application):
     debug = cli.Flag(["d", "debug"])
+    session_timeout = cli.SwitchAttr(
+        ["session-timeout"], float,
+        help=("Seconds to wait for other chroot sessions to leave before "
+              "detaching mounts they still use; waits indefinitely by "
+              "default"))
+    agent = cli.Flag(
+        ["agent"],
+        help=("Run chroot commands through one long-lived shell which "
+              "sources /etc/profile once; commands run this way don't get "
+              "stdin"))
+    inject_files = cli.SwitchAttr(
+        ["inject-file"], cli.ExistingFile, list=True,
+        help=("Host file to put into chroot while it's in use, like "
+              "/etc/resolv.conf which always is; can be given multiple "
+              "times"))
+    distdir = cli.SwitchAttr(
+        ["distdir"], str,
+        help=("Host directory of distfiles shared by chroots, bind mounted "
+              f"over {DISTDIR}"))
+    pkgdir = cli.SwitchAttr(
+        ["pkgdir"], str,
+        help=("Host directory of binary packages shared by chroots, bind "
+              f"mounted over {PKGDIR}"))
+    portage_tmpfs = cli.SwitchAttr(
+        ["portage-tmpfs"], parse_size,
+        help=("Build in tmpfs of this size, e.g. 16G, mounted over "
+              f"{PORTAGE_TMPFS_DIR}; packages listed in "
+              "/etc/portage/package.env/geni-notmpfs* are built on disk"))
+    ccache = cli.SwitchAttr(
+        ["ccache"], str,
+        help=("Host ccache directory shared by chroots, bind mounted over "
+              f"{CCACHE_DIR} and used by emerge if ccache is installed in "
+              "chroot"))
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.chroot_dir = ''
         self.work_dir = ''
         self.chroot: Optional[Chroot] = None
+        self.distdir_cache: Optional[SharedCache] = None
+        self.pkgdir_cache: Optional[SharedCache] = None
+        self.ccache_cache: Optional[SharedCache] = None
+
+    def make_emerge_env_vars(self) -> Dict[str, str]:
+        if self.ccache_cache is None:
+            return {}
+        return make_ccache_env_vars(self.chroot_dir)
+
+    def reporting_ccache_stats(self) -> ContextManager[None]:
+        return reporting_ccache_stats(self.ccache_cache.path
+                                      if self.ccache_cache is not None
+                                      else None)
 
     def main(self) -> int:  # pylint: disable=arguments-differ
         logging.basicConfig(level=(logging.DEBUG
@@ -275,7 +771,26 @@ class Geni(cli.Application):
 
         self.work_dir = make_work_dir()
         self.chroot_dir = make_chroot_dir(self.work_dir)
-        self.chroot = Chroot(self.chroot_dir, self.work_dir)
+        ChrootClone(self.work_dir, self.chroot_dir).ensure_mounted()
+        if self.distdir:
+            self.distdir_cache = SharedCache(self.distdir, DISTDIR)
+        if self.pkgdir:
+            self.pkgdir_cache = SharedCache(self.pkgdir, PKGDIR)
+        if self.ccache:
+            self.ccache_cache = SharedCache(self.ccache, CCACHE_DIR)
+        self.chroot = Chroot(self.chroot_dir,
+                             self.work_dir,
+                             session_timeout=self.session_timeout,
+                             use_agent=self.agent,
+                             inject_files=self.inject_files,
+                             shared_caches=[
+                                 cache
+                                 for cache in [self.distdir_cache,
+                                               self.pkgdir_cache,
+                                               self.ccache_cache]
+                                 if cache is not None
+                             ],
+                             portage_tmpfs_size=self.portage_tmpfs)
 
         return 0
 
@@ -301,6 +816,51 @@ class GeniManage(cli.Application):
 class GeniManageBootstrap(cli.Application):
     """Downloads and unpacks Gentoo stage3 tarball, configures portage
     """
+    mirrors = cli.SwitchAttr(
+        ["mirror"], str, list=True,
+        help=("Gentoo mirror URL, can be given multiple times; overrides "
+              "mirrors file"))
+    mirrors_file = cli.SwitchAttr(
+        ["mirrors-file"], cli.ExistingFile,
+        help=("File listing mirror URLs, one per line; defaults to "
+              "$GENI_MIRRORS_FILE or ~/.config/geni/mirrors"))
+    spread_mirrors = cli.SwitchAttr(
+        ["spread-mirrors"], cli.Range(1, 16), default=1,
+        help="Number of fastest mirrors to spread download segments over")
+    connections = cli.SwitchAttr(
+        ["connections"], cli.Range(1, 32), default=4,
+        help="Number of parallel connections used to download the tarball")
+    segment_size = cli.SwitchAttr(
+        ["segment-size"], cli.Range(1, 1024), default=16,
+        help="Size of a single ranged download segment in MiB")
+    timeout = cli.SwitchAttr(
+        ["timeout"], float, default=TransportConfig().read_timeout,
+        help=("Seconds to wait for data from a mirror before failing over "
+              "to the next one"))
+    retries = cli.SwitchAttr(
+        ["retries"], cli.Range(0, 10), default=TransportConfig().retries,
+        help="Number of retries of a failed request, with backoff")
+    stream_extract = cli.Flag(
+        ["stream-extract"],
+        help="Extract stage3 tarball while it's being downloaded")
+    decompressor = cli.SwitchAttr(
+        ["decompressor"], cli.Set(*DECOMPRESSOR_CHOICES), default="auto",
+        help=("Program to decompress stage3 tarball with; 'auto' picks "
+              "a parallel one if available, 'tar' leaves it to tar"))
+    cache_max_size = cli.SwitchAttr(
+        ["cache-max-size"], parse_size,
+        help=("Evict least recently used stage3 tarballs from cache above "
+              "this size, e.g. 2G"))
+    clone = cli.SwitchAttr(
+        ["clone"], cli.Set(*CLONE_MODES), default="extract",
+        help=("How to create chroot: 'extract' the tarball into it or clone "
+              "golden tree of the release with 'reflink' copy or "
+              "'overlay' mount"))
+    ram_per_job = cli.SwitchAttr(
+        ["ram-per-job"], parse_size, default=RAM_PER_JOB,
+        help=("Memory to count on per compiler job when setting build "
+              "parallelism of make.conf from CPUs and available memory"))
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.gpg_aside: Optional[GpgAside] = None
@@ -317,42 +877,117 @@ class GeniManageBootstrap(cli.Application):
         downloads_dir = os.path.join(self.parent.work_dir,
                                      "downloads")
 
-        install_stage_tarball(self.gpg_aside,
-                              GENTOO_MIRROR,
-                              downloads_dir,
-                              self.parent.chroot_dir)
+        mirror_urls = load_mirrors(self.mirrors,
+                                   self.mirrors_file or default_mirrors_file(),
+                                   GENTOO_MIRROR)
+        session = Session(TransportConfig(
+            pool_size=self.connections,
+            read_timeout=self.timeout,
+            retries=self.retries))
+        if len(mirror_urls) > 1:
+            mirror_urls = rank_mirrors(
+                session,
+                mirror_urls,
+                join_url(StageDownloader.AUTOBUILDS_PATH,
+                         StageDownloader.LATEST_STAGE_POINTER))
+
+        stage_downloader = StageDownloader(
+            mirror_urls,
+            downloads_dir,
+            connections=self.connections,
+            segment_size=self.segment_size * 1024 * 1024,
+            spread=self.spread_mirrors,
+            session=session)
+
+        release_cache = ReleaseCache(default_cache_dir(),
+                                     max_size=self.cache_max_size)
+        chroot_clone = ChrootClone(self.parent.work_dir,
+                                   self.parent.chroot_dir)
 
-        configure_portage_basic(self.parent.chroot)
+        install_stage_tarball(self.gpg_aside,
+                              stage_downloader,
+                              self.parent.chroot_dir,
+                              release_cache=release_cache,
+                              stream_extract=self.stream_extract,
+                              decompressor=self.decompressor,
+                              clone_mode=self.clone,
+                              chroot_clone=chroot_clone)
+
+        configure_portage_basic(
+            self.parent.chroot,
+            compute_parallelism(
+                ram_per_job=self.ram_per_job,
+                tmpfs_size=self.parent.parent.portage_tmpfs or 0))
 
         return 0
 
 
-def install_tree(chroot_dir: str, source_path: str) -> None:
+def make_install_manifest(work_dir: str, source_path: str) -> InstallManifest:
+    manifests_dir = os.path.join(work_dir, "install-tree")
+    os.makedirs(manifests_dir, exist_ok=True)
+    return InstallManifest(os.path.join(
+        manifests_dir, hash_path(os.path.realpath(source_path)) + ".json"))
+
+
+def install_tree(chroot_dir: str,
+                 source_path: str,
+                 manifest: InstallManifest,
+                 dry_run: bool = False,
+                 delete: bool = False) -> None:
+    """Installs files of tree which changed since installed. Files
+    installed before from the tree but gone from it are removed if `delete`
+    is set.
+    """
     if not os.path.exists(source_path):
         raise FileNotFoundError(source_path)
     if not os.path.isdir(source_path):
         raise NotADirectoryError(source_path)
 
-    finst = FileInstaller(source_path, chroot_dir)
-    for root, _dirs, files in os.walk(source_path):
-        rel_root = root[len(source_path):]
-        for file_name in files:
-            file_path = os.path.join(rel_root, file_name)
-            logging.debug("Installing %s", file_path)
-            finst.install(file_path)
+    full_plan = InstallPlan(source_path, chroot_dir)
+    full_plan.add_tree()
+    plan = full_plan.changed()
+    source_files = {entry.rel_path for entry in full_plan.files}
+    installed_files = manifest.load()
+    vanished_files = installed_files - source_files if delete else set()
+    logging.info("%d of %d files changed", len(plan.files), len(source_files))
 
+    if dry_run:
+        for line in plan.describe():
+            print(line)
+        for rel_path in sorted(vanished_files):
+            print(f"delete {plan.target_path(rel_path)}")
+        return
 
-def select_portage_profile(chroot: Chroot, portage_profile: str) -> None:
-    with chroot as chroot_exec:
-        chroot_exec("eselect", "profile", "set", portage_profile)
+    plan.apply()
+    plan.remove(vanished_files)
+    manifest.save((installed_files - vanished_files) | source_files)
+
+
+def select_portage_profile(chroot_exec: ChrootExec,
+                           portage_profile: str) -> None:
+    chroot_exec("eselect", "profile", "set", portage_profile)
 
 
 @GeniManage.subcommand("install-tree")
 class GeniManageInstallTree(cli.Application):
     """Installs tree into chroot
     """
+    dry_run = cli.Flag(
+        ["-n", "--dry-run"],
+        help="List files and directories to install without installing")
+
+    delete = cli.Flag(
+        ["--delete"],
+        help=("Remove files installed before from the tree which are no "
+              "longer in it"))
+
     def main(self, source_path: str) -> int:  # noqa: E501 pylint: disable=arguments-differ
-        install_tree(self.parent.chroot_dir, source_path)
+        manifest = make_install_manifest(self.parent.work_dir, source_path)
+        install_tree(self.parent.chroot_dir,
+                     source_path,
+                     manifest,
+                     dry_run=self.dry_run,
+                     delete=self.delete)
         return 0
 
 
@@ -361,7 +996,11 @@ class GeniManageCleanDist(cli.Application):
     """Cleans portage distdir content
     """
     def main(self) -> int:  # pylint: disable=arguments-differ
-        clean_distdir(self.parent.chroot)
+        distdir_cache = self.parent.parent.distdir_cache
+        if distdir_cache is not None:
+            distdir_cache.clean()
+        else:
+            clean_distdir(self.parent.chroot)
         return 0
 
 
@@ -375,25 +1014,78 @@ class GeniManageConfigure(cli.Application):
     timezone = cli.SwitchAttr(["timezone"], str)
     portage_profile = cli.SwitchAttr(["portage-profile"], str)
     portage_extras = cli.SwitchAttr(["portage-extras"])
-
-    def main(self) -> int:  # pylint: disable=arguments-differ
+    notmpfs_packages = cli.SwitchAttr(
+        ["notmpfs-package"], str, list=True,
+        help=("Package to build on disk instead of tmpfs of "
+              "--portage-tmpfs, e.g. too big for RAM; can be given multiple "
+              "times"))
+
+    def make_chroot_steps(self, chroot_exec: ChrootExec) -> List[Step]:
+        """Makes steps run in chroot, declaring paths they read and write.
+        """
+        chroot_dir = self.parent.chroot_dir
+        steps = []
         if self.timezone:
-            configure_time_zone(self.parent.chroot, self.timezone)
-
+            steps.append(Step(
+                "timezone",
+                functools.partial(configure_time_zone,
+                                  chroot_dir, chroot_exec, self.timezone),
+                reads={"/etc/portage/make.profile"},
+                writes={"/etc/timezone", "/etc/localtime"}))
         if self.locale_gen:
-            generate_locales(self.parent.chroot, self.locale_gen)
-
+            steps.append(Step(
+                "locale-gen",
+                functools.partial(generate_locales,
+                                  chroot_dir, chroot_exec, self.locale_gen),
+                writes={"/etc/locale.gen", "/usr/lib/locale"}))
         if self.locale:
-            set_locale(self.parent.chroot, self.locale)
-
-        if self.net_simple_names:
-            configure_net_simple_names(self.parent.chroot_dir)
-
+            steps.append(Step(
+                "locale",
+                functools.partial(set_locale, chroot_exec, self.locale),
+                reads={"/usr/lib/locale"},
+                writes={"/etc/env.d/02locale"}))
         if self.portage_profile:
-            select_portage_profile(self.parent.chroot, self.portage_profile)
-
+            steps.append(Step(
+                "portage-profile",
+                functools.partial(select_portage_profile,
+                                  chroot_exec, self.portage_profile),
+                writes={"/etc/portage/make.profile"}))
+        return steps
+
+    def make_host_steps(self) -> List[Step]:
+        """Makes steps run on host, declaring paths they write in chroot.
+        """
+        chroot_dir = self.parent.chroot_dir
+        steps = []
+        if self.net_simple_names:
+            steps.append(Step(
+                "net-simple-names",
+                functools.partial(configure_net_simple_names, chroot_dir),
+                writes={"/etc/udev/rules.d"}))
         if self.portage_extras:
-            configure_portage_extras(self.parent.chroot_dir)
+            steps.append(Step(
+                "portage-extras",
+                functools.partial(configure_portage_extras, chroot_dir),
+                writes={"/etc/portage/repo.postsync.d"}))
+        if self.notmpfs_packages:
+            steps.append(Step(
+                "notmpfs-packages",
+                functools.partial(configure_notmpfs_packages,
+                                  chroot_dir, self.notmpfs_packages),
+                writes={"/etc/portage/package.env"}))
+        return steps
+
+    def main(self) -> int:  # pylint: disable=arguments-differ
+        needs_chroot = (self.timezone
+                        or self.locale_gen
+                        or self.locale
+                        or self.portage_profile)
+        if needs_chroot:
+            with self.parent.chroot as chroot_exec:
+                run_steps(self.make_chroot_steps(chroot_exec)
+                          + self.make_host_steps())
+        else:
+            run_steps(self.make_host_steps())
 
         return 0
 
@@ -406,19 +1098,58 @@ class GeniManageSyncRepo(cli.Application):
         return 0
 
 
+class EmergeParallelismSwitches(cli.Application):
+    """Switches overriding build parallelism set in make.conf
+    """
+    jobs = cli.SwitchAttr(
+        ["jobs"], cli.Range(1, 1024),
+        help="Number of packages to build at once (emerge --jobs)")
+    load_average = cli.SwitchAttr(
+        ["load-average"], float,
+        help="Load average above which emerge starts no new packages")
+    makeopts = cli.SwitchAttr(
+        ["makeopts"], str,
+        help="MAKEOPTS to build with, e.g. '-j8 -l8'")
+
+    def make_emerge_opts(self) -> List[str]:
+        opts = []
+        if self.jobs is not None:
+            opts.extend(["--jobs", str(self.jobs)])
+        if self.load_average is not None:
+            opts.extend(["--load-average", f"{self.load_average:g}"])
+        return opts
+
+    def make_env_vars(self, env_vars: Dict[str, str]) -> Dict[str, str]:
+        if self.makeopts is None:
+            return env_vars
+        return {**env_vars, "MAKEOPTS": self.makeopts}
+
+
 @GeniManage.subcommand("upgrade")
-class GeniManageUpgrade(cli.Application):
+class GeniManageUpgrade(EmergeParallelismSwitches):
     def main(self) -> int:  # pylint: disable=arguments-differ
-        sync_repo(self.parent.chroot)
-        upgrade_system(self.parent.chroot)
+        geni = self.parent.parent
+        batch = self.parent.chroot.batch()
+        queue_sync_repo(self.parent.chroot_dir, batch)
+        upgrade_system(batch,
+                       self.make_env_vars(geni.make_emerge_env_vars()),
+                       self.make_emerge_opts())
+        logging.info("Syncing portage tree and updating @world...")
+        with geni.reporting_ccache_stats():
+            batch.run(stream=True)
 
         return 0
 
 
 @GeniManage.subcommand("emerge")
-class GeniManageEmerge(cli.Application):
+class GeniManageEmerge(EmergeParallelismSwitches):
     def main(self, *packages: str) -> int:  # pylint: disable=arguments-differ
-        emerge(self.parent.chroot, list(packages))
+        geni = self.parent.parent
+        with geni.reporting_ccache_stats():
+            emerge(self.parent.chroot,
+                   list(packages),
+                   self.make_env_vars(geni.make_emerge_env_vars()),
+                   self.make_emerge_opts())
 
         return 0
 
@@ -434,40 +1165,154 @@ class GeniChroot(cli.Application):
 
     refresh_gentoo_cache = cli.Flag("--refresh-gentoo-cache")
 
-    @contextmanager
-    def enter_chroot(self):
-        with MountsManager(self.parent.chroot_dir) as mounts:
-            if self.chroot_overlay:
-                os.makedirs(self.chroot_overlay, exist_ok=True)
-                chroot_overlay = OverlayMount(self.parent.chroot_dir,
-                                              self.chroot_overlay)
-                mounts.add(chroot_overlay)
-
-            if self.bind_repo:
-                # portageq get_repo_path / gentoo 2>/dev/null
-                chroot_repo_dir = os.path.join(self.parent.chroot_dir,
-                                               "usr",
-                                               "portage")
-                repo = BindMount(self.bind_repo, chroot_repo_dir)
-                mounts.add(repo)
+    private_mounts = cli.Flag(
+        ["p", "private-mounts"],
+        help=("Mount chroot file systems and the mounts above in a private "
+              "mount namespace of each command instead of sharing them with "
+              "other sessions"))
 
-            if self.xorg:
-                x11_unix_dir = "/tmp/.X11-unix"
-                chroot_x11_unix_dir = os.path.join(self.parent.chroot_dir,
-                                                   x11_unix_dir.lstrip("/"))
-                os.makedirs(chroot_x11_unix_dir, exist_ok=True)
-                mounts.add(BindMount(x11_unix_dir, chroot_x11_unix_dir))
+    X11_UNIX_DIR = "/tmp/.X11-unix"
 
-            with self.parent.chroot as chroot_exec:
-                if self.bind_repo and self.refresh_gentoo_cache:
-                    chroot_exec(
-                        '/etc/portage/repo.postsync.d/sync_gentoo_cache',
+    def _chroot_path(self, path: str) -> str:
+        return os.path.join(self.parent.chroot_dir, path.lstrip("/"))
+
+    def _make_mounts(self) -> List[Mount]:
+        mounts: List[Mount] = []
+
+        if self.chroot_overlay:
+            os.makedirs(self.chroot_overlay, exist_ok=True)
+            mounts.append(OverlayMount(self.parent.chroot_dir,
+                                       self.chroot_overlay))
+
+        if self.bind_repo:
+            # portageq get_repo_path / gentoo 2>/dev/null
+            mounts.append(BindMount(self.bind_repo,
+                                    self._chroot_path("/usr/portage")))
+
+        return mounts
+
+    def _refresh_gentoo_cache(self, chroot_exec: ChrootExec) -> None:
+        if self.bind_repo and self.refresh_gentoo_cache:
+            chroot_exec('/etc/portage/repo.postsync.d/sync_gentoo_cache',
                         'gentoo',
                         '',
                         '/usr/portage')
+
+    @contextmanager
+    def _enter_shared_chroot(self):
+        with MountsManager(self.parent.chroot_dir,
+                           self.parent.chroot.mount_journal) as mounts:
+            for mount_ in self._make_mounts():
+                mounts.add(mount_)
+
+            if self.xorg:
+                chroot_x11_unix_dir = self._chroot_path(self.X11_UNIX_DIR)
+                os.makedirs(chroot_x11_unix_dir, exist_ok=True)
+                mounts.add(BindMount(self.X11_UNIX_DIR, chroot_x11_unix_dir))
+
+            try:
+                with self.parent.chroot as chroot_exec:
+                    yield chroot_exec
+            finally:
+                if mounts.mounts \
+                        and not self.parent.chroot.wait_for_other_sessions():
+                    logging.warning("Other chroot sessions are still in, "
+                                    "detaching mounts lazily")
+                    mounts.umount_all(lazy=True)
+
+    def _make_private_exec(self) -> PrivateChrootExec:
+        extra_commands = []
+        if self.xorg:
+            # After chroot's /tmp is mounted, so that it's not hidden.
+            chroot_x11_unix_dir = self._chroot_path(self.X11_UNIX_DIR)
+            extra_commands.append(["mkdir", "-p", chroot_x11_unix_dir])
+            extra_commands.extend(
+                BindMount(self.X11_UNIX_DIR,
+                          chroot_x11_unix_dir).mount_commands())
+
+        return self.parent.chroot.private_exec(self._make_mounts(),
+                                               extra_commands)
+
+    @contextmanager
+    def enter_chroot(self):
+        if self.private_mounts:
+            chroot = self.parent.chroot
+            chroot_exec = chroot.make_exec(self._make_private_exec())
+            try:
+                self._refresh_gentoo_cache(chroot_exec)
+                yield chroot_exec
+            finally:
+                chroot.clean_up()
+        else:
+            with self._enter_shared_chroot() as chroot_exec:
+                self._refresh_gentoo_cache(chroot_exec)
                 yield chroot_exec
 
 
+@Geni.subcommand("cache")
+class GeniCache(cli.Application):
+    """Manages cache of stage3 tarballs shared by work directories
+    """
+    @property
+    def release_cache(self) -> ReleaseCache:
+        return ReleaseCache(default_cache_dir())
+
+
+@GeniCache.subcommand("list")
+class GeniCacheList(cli.Application):
+    """Lists cached stage3 tarballs, most recently used first
+    """
+    def main(self) -> int:  # pylint: disable=arguments-differ
+        for entry in self.parent.release_cache.entries():
+            print(f"{entry.release}  "
+                  f"{entry.size / 2**20:.1f} MiB  "
+                  f"used {arrow.get(entry.last_used).humanize()}  "
+                  f"{entry.key}")
+        return 0
+
+
+@GeniCache.subcommand("prune")
+class GeniCachePrune(cli.Application):
+    """Evicts least recently used stage3 tarballs from cache
+    """
+    max_size = cli.SwitchAttr(["max-size"], parse_size,
+                              help="Maximum cache size, e.g. 2G")
+    max_age = cli.SwitchAttr(["max-age"], float,
+                             help="Maximum days since last use")
+    distdir_max_size = cli.SwitchAttr(
+        ["distdir-max-size"], parse_size,
+        help=("Maximum size of shared distdir (--distdir), least recently "
+              "used files are removed first"))
+    pkgdir_max_size = cli.SwitchAttr(
+        ["pkgdir-max-size"], parse_size,
+        help=("Maximum size of shared pkgdir (--pkgdir), least recently "
+              "used packages are removed first"))
+
+    def prune_shared_caches(self) -> None:
+        geni = self.parent.parent
+        for cache, max_size in [(geni.distdir_cache, self.distdir_max_size),
+                                (geni.pkgdir_cache, self.pkgdir_max_size)]:
+            if max_size is None:
+                continue
+            if cache is None:
+                raise GeniException(
+                    "Shared cache to prune needs --distdir or --pkgdir")
+            cache.prune(max_size)
+
+    def main(self) -> int:  # pylint: disable=arguments-differ
+        self.prune_shared_caches()
+
+        release_cache = self.parent.release_cache
+        max_age = self.max_age * 86400 if self.max_age is not None else None
+        removed = release_cache.prune(self.max_size, max_age)
+        logging.info("Removed %d stage3 tarballs from cache", len(removed))
+
+        golden_images = GoldenImages(release_cache.cache_dir)
+        golden_images.prune(keep=[entry.key
+                                  for entry in release_cache.entries()])
+        return 0
+
+
 @GeniChroot.subcommand("exec")
 class GeniChrootExec(cli.Application):
     def main(self, *args) -> int:  # pylint: disable=arguments-differ
@@ -490,6 +1335,17 @@ class GeniChrootRun(cli.Application):
         return 0
 
 
+@GeniChroot.subcommand("recover")
+class GeniChrootRecover(cli.Application):
+    """Cleans up mounts left under chroot by killed geni processes
+    """
+    def main(self) -> int:  # pylint: disable=arguments-differ
+        if not self.parent.parent.chroot.recover():
+            logging.error("Chroot is in use, not recovering")
+            return 1
+        return 0
+
+
 @GeniChroot.subcommand("shell")
 class GeniChrootShell(cli.Application):
     def main(self) -> int:  # pylint: disable=arguments-differ
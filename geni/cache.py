@@ -0,0 +1,181 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import os.path
+import shutil
+import time
+from typing import AbstractSet, Dict, Iterator, List, NamedTuple, Optional
+
+from plumbum import local
+
+from .download import StoredDigests
+
+
+def default_cache_dir() -> str:
+    cache_home = local.env.get("XDG_CACHE_HOME",
+                               os.path.expanduser("~/.cache"))
+    return local.env.get("GENI_CACHE_DIR", os.path.join(cache_home, "geni"))
+
+
+def make_cache_key(hash_name: str, digest: str) -> str:
+    return f"{hash_name}-{digest.lower()}"
+
+
+class CacheEntry(NamedTuple):
+    key: str
+    release: str
+    file_name: str
+    size: int
+    last_used: float
+
+
+class ReleaseCache:
+    """Content-addressed cache of stage3 tarballs shared by work dirs.
+
+    Tarballs are stored under their digest. The index keeps release, size
+    and last use time of every entry, so the least recently used entries
+    can be evicted when the cache grows over `max_size` bytes.
+    """
+    def __init__(self,
+                 cache_dir: str,
+                 max_size: Optional[int] = None) -> None:
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.stages_dir = os.path.join(cache_dir, "stages")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock_path = os.path.join(cache_dir, "index.lock")
+        os.makedirs(self.stages_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked_index(self) -> Iterator[Dict[str, dict]]:
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.index_path, "r") as index_file:
+                    index = json.load(index_file)
+            except (FileNotFoundError, ValueError):
+                index = {}
+
+            yield index
+
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w") as index_file:
+                json.dump(index, index_file, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.index_path)
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.stages_dir, key)
+
+    def _entry_path(self, key: str, file_name: str) -> str:
+        return os.path.join(self._entry_dir(key), file_name)
+
+    def get(self, hash_name: str, digest: str) -> Optional[str]:
+        """Returns path of cached tarball with given digest if there's one.
+        """
+        key = make_cache_key(hash_name, digest)
+        with self._locked_index() as index:
+            metadata = index.get(key)
+            if metadata is None:
+                return None
+            path = self._entry_path(key, metadata["file_name"])
+            if not os.path.exists(path):
+                del index[key]
+                return None
+            metadata["last_used"] = time.time()
+            return path
+
+    def add(self,
+            path: str,
+            hash_name: str,
+            digest: str,
+            release: str) -> str:
+        """Moves verified tarball into the cache.
+
+        :return: New path of the tarball.
+        """
+        key = make_cache_key(hash_name, digest)
+        file_name = os.path.basename(path)
+        cached_path = self._entry_path(key, file_name)
+
+        with self._locked_index() as index:
+            os.makedirs(self._entry_dir(key), exist_ok=True)
+            shutil.move(path, cached_path)
+            stored_digests = StoredDigests(path)
+            if os.path.exists(stored_digests.path):
+                shutil.move(stored_digests.path,
+                            StoredDigests(cached_path).path)
+            index[key] = {
+                "release": release,
+                "file_name": file_name,
+                "size": os.path.getsize(cached_path),
+                "last_used": time.time(),
+            }
+            if self.max_size is not None:
+                self._evict(index, self.max_size, None, keep={key})
+
+        return cached_path
+
+    def remove(self, hash_name: str, digest: str) -> None:
+        """Evicts tarball with given digest if it's cached, e.g. once it's
+        found corrupted.
+        """
+        key = make_cache_key(hash_name, digest)
+        with self._locked_index() as index:
+            if key in index:
+                self._remove(index, self._entries({key: index[key]})[0])
+
+    def entries(self) -> List[CacheEntry]:
+        with self._locked_index() as index:
+            return self._entries(index)
+
+    @staticmethod
+    def _entries(index: Dict[str, dict]) -> List[CacheEntry]:
+        return sorted((CacheEntry(key,
+                                  metadata["release"],
+                                  metadata["file_name"],
+                                  metadata["size"],
+                                  metadata["last_used"])
+                       for key, metadata in index.items()),
+                      key=lambda entry: entry.last_used,
+                      reverse=True)
+
+    def _remove(self, index: Dict[str, dict], entry: CacheEntry) -> None:
+        logging.info("Evicting %s from cache", entry.release)
+        shutil.rmtree(self._entry_dir(entry.key), ignore_errors=True)
+        del index[entry.key]
+
+    def _evict(self,
+               index: Dict[str, dict],
+               max_size: Optional[int],
+               max_age: Optional[float],
+               keep: AbstractSet[str] = frozenset()) -> List[CacheEntry]:
+        removed = []
+        total_size = 0
+        now = time.time()
+
+        for entry in self._entries(index):
+            missing = not os.path.exists(self._entry_path(entry.key,
+                                                          entry.file_name))
+            too_old = max_age is not None and now - entry.last_used > max_age
+            too_big = (max_size is not None
+                       and total_size + entry.size > max_size)
+            if entry.key not in keep and (missing or too_old or too_big):
+                self._remove(index, entry)
+                removed.append(entry)
+            else:
+                total_size += entry.size
+
+        return removed
+
+    def prune(self,
+              max_size: Optional[int] = None,
+              max_age: Optional[float] = None) -> List[CacheEntry]:
+        """Evicts least recently used entries over `max_size` bytes and
+        entries not used for `max_age` seconds.
+
+        :return: Removed entries.
+        """
+        with self._locked_index() as index:
+            return self._evict(index, max_size, max_age)
@@ -0,0 +1,91 @@
+from contextlib import contextmanager
+import glob
+import logging
+import os.path
+from typing import Dict, Iterator, NamedTuple, Optional
+
+CCACHE_DIR = "/var/cache/ccache"
+
+# Counters of ccache stats files, numbered as in ccache's Statistic enum.
+_CACHE_MISS = 4
+_PREPROCESSED_CACHE_HIT = 8
+_DIRECT_CACHE_HIT = 22
+
+
+class CcacheStats(NamedTuple):
+    hits: int
+    misses: int
+
+    def __sub__(self, other) -> 'CcacheStats':
+        return CcacheStats(self.hits - other.hits,
+                           self.misses - other.misses)
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+
+def _counter(counters: list, index: int) -> int:
+    return int(counters[index]) if index < len(counters) else 0
+
+
+def read_ccache_stats(ccache_dir: str) -> CcacheStats:
+    """Sums up counters of stats files of ccache directory, read on host, so
+    ccache doesn't need to be installed there.
+    """
+    hits = misses = 0
+    # Newer ccache versions keep stats in level 2 directories.
+    stats_paths = [os.path.join(ccache_dir, "stats"),
+                   *glob.glob(os.path.join(ccache_dir, "?", "stats")),
+                   *glob.glob(os.path.join(ccache_dir, "?", "?", "stats"))]
+    for stats_path in stats_paths:
+        try:
+            with open(stats_path, "r") as stats_file:
+                counters = stats_file.read().split()
+        except (FileNotFoundError, PermissionError):
+            continue
+        hits += (_counter(counters, _DIRECT_CACHE_HIT)
+                 + _counter(counters, _PREPROCESSED_CACHE_HIT))
+        misses += _counter(counters, _CACHE_MISS)
+    return CcacheStats(hits, misses)
+
+
+def make_ccache_env_vars(chroot_dir: str) -> Dict[str, str]:
+    """Makes environment variables enabling ccache for emerge, unless it's
+    not installed in chroot.
+    """
+    if not os.path.exists(os.path.join(chroot_dir, "usr", "bin", "ccache")):
+        logging.warning("ccache is not installed in chroot, emerge "
+                        "dev-util/ccache to use it")
+        return {}
+    # FEATURES is incremental, so it's added to the ones of make.conf.
+    return {"FEATURES": "ccache", "CCACHE_DIR": CCACHE_DIR}
+
+
+def log_ccache_stats(stats: CcacheStats, total_stats: CcacheStats) -> None:
+    def hit_rate(stats: CcacheStats) -> str:
+        return "n/a" if stats.hit_rate is None else f"{stats.hit_rate:.0%}"
+
+    logging.info("ccache: %d hits, %d misses (%s hit rate); "
+                 "%s hit rate overall",
+                 stats.hits,
+                 stats.misses,
+                 hit_rate(stats),
+                 hit_rate(total_stats))
+
+
+@contextmanager
+def reporting_ccache_stats(ccache_dir: Optional[str]) -> Iterator[None]:
+    """Logs ccache hits and misses of the block, if there's ccache.
+    """
+    if ccache_dir is None:
+        yield
+        return
+
+    stats_before = read_ccache_stats(ccache_dir)
+    try:
+        yield
+    finally:
+        stats_after = read_ccache_stats(ccache_dir)
+        log_ccache_stats(stats_after - stats_before, stats_after)
@@ -1,23 +1,140 @@
+import fcntl
+import io
+import logging
+import os
 import os.path
+import re
+import selectors
 import shlex
+import subprocess
 import sys
-import time
-from typing import Optional, Type
+import threading
+from typing import (IO,
+                    BinaryIO,
+                    Callable,
+                    Dict,
+                    List,
+                    NamedTuple,
+                    Optional,
+                    Sequence,
+                    Tuple,
+                    Type,
+                    cast)
+import uuid
 
-from plumbum import BG, FG
+from plumbum import BG, FG, ProcessExecutionError
 from plumbum.cmd import (chroot,  # pylint: disable=import-error
-                         mountpoint,
                          sudo)
 
 from .exceptions import GeniException
-from .mount import MountsManager
+from .hostfiles import HostFiles
+from .install import InstallManifest
+from .mount import (BindMount,
+                    Mount,
+                    MountJournal,
+                    MountsManager,
+                    read_mount_points)
+from .shared import SharedCache
 from .util import (ExceptionEater,
                    FileSemaphore,
-                   FileTempInst,
+                   flock_waiting,
                    hash_path,
+                   make_script,
                    no_escaping)
 
 
+# Build directory of portage with default PORTAGE_TMPDIR.
+PORTAGE_TMPFS_DIR = "/var/tmp/portage"
+
+
+def _mark_end(token: str) -> str:
+    """Shell command printing end marker of a command, with its return code
+    taken from `retcode` variable. The marker starts with NUL byte, which
+    doesn't occur in text output.
+    """
+    return f"printf '\\000%s %d\\n' {token} $retcode"
+
+
+class _MarkedOutput:
+    """Output of commands, each one followed by end marker with return code.
+
+    Output is passed on to `sink` as it comes if there's one, otherwise
+    it's kept per command.
+    """
+    def __init__(self, token: str, sink: Optional[BinaryIO] = None) -> None:
+        self.marker_prefix = b"\0" + token.encode() + b" "
+        self.marker_re = re.compile(re.escape(self.marker_prefix)
+                                    + b"(\\d+)\n")
+        self.sink = sink
+        self.data = b""
+        self.pending = b""
+        self.outputs: List[bytes] = []
+        self.retcodes: List[int] = []
+
+    def _pass_on(self, data: bytes) -> None:
+        if self.sink is None:
+            self.pending += data
+        elif data:
+            self.sink.write(data)
+            self.sink.flush()
+
+    def _safe_end(self) -> int:
+        """Position up to which data can't be part of a marker."""
+        marker_start = self.data.rfind(b"\0")
+        tail = self.data[marker_start:]
+        if marker_start >= 0 \
+                and (self.marker_prefix.startswith(tail)
+                     or (tail.startswith(self.marker_prefix)
+                         and tail[len(self.marker_prefix):].isdigit())):
+            return marker_start
+        return len(self.data)
+
+    def write(self, chunk: bytes) -> None:
+        self.data += chunk
+        match = self.marker_re.search(self.data)
+        while match:
+            self._pass_on(self.data[:match.start()])
+            self.outputs.append(self.pending)
+            self.pending = b""
+            self.retcodes.append(int(match.group(1)))
+            self.data = self.data[match.end():]
+            match = self.marker_re.search(self.data)
+
+        safe_end = self._safe_end()
+        self._pass_on(self.data[:safe_end])
+        self.data = self.data[safe_end:]
+
+    def flush(self) -> None:
+        pass
+
+    def text(self, index: int = 0) -> str:
+        if index >= len(self.outputs):
+            return ""
+        return self.outputs[index].decode("utf-8", errors="replace")
+
+
+def _pump(sinks: Dict[int, BinaryIO],
+          until: Callable[[], bool] = lambda: False) -> bool:
+    """Copies data from pipes to their sinks until `until` returns True or
+    all the pipes are closed.
+
+    :return: Whether `until` returned True.
+    """
+    with selectors.DefaultSelector() as selector:
+        for pipe_fd in sinks:
+            selector.register(pipe_fd, selectors.EVENT_READ)
+
+        while selector.get_map() and not until():
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, 65536)
+                if chunk:
+                    sinks[key.fd].write(chunk)
+                else:
+                    selector.unregister(key.fd)
+
+    return until()
+
+
 class ChrootExec:
     def __init__(self, chroot_dir: str) -> None:
         self.chroot_dir = chroot_dir
@@ -25,17 +142,21 @@ class ChrootExec:
     def prep_bare(self, *args):
         return sudo[chroot[self.chroot_dir, args]]
 
-    def prep(self, *args, env_vars={}):
-        source_etc_profile = "source /etc/profile"
+    @staticmethod
+    def make_command(args, env_vars) -> str:
         env_vars_str = " ".join(
             "{key}={value}".format(key=key, value=shlex.quote(value))
             for key, value in env_vars.items()
         )
         command = " ".join(map(shlex.quote, args))
+        return f"{env_vars_str} {command}"
+
+    def prep(self, *args, env_vars={}):
+        source_etc_profile = "source /etc/profile"
         return self.prep_bare(
             "/bin/bash",
             "-c",
-            f"{source_etc_profile} && {env_vars_str} {command}"
+            f"{source_etc_profile} && {self.make_command(args, env_vars)}"
         )
 
     def __call__(self, *args, env_vars={}):
@@ -56,67 +177,488 @@ class ChrootExec:
     def shell(self):
         self.prep_bare("/bin/bash", "-l") & FG  # noqa: E501 pylint: disable=expression-not-assigned
 
+    def run_script(self,
+                   script: str,
+                   stdout_sink: Optional[BinaryIO] = None,
+                   stderr_sink: Optional[BinaryIO] = None
+                   ) -> Tuple[int, str, str]:
+        """Runs bash script with profile sourced. Output is passed on to
+        sinks as it comes, if they're given, instead of being returned.
+
+        :return: Return code, stdout and stderr.
+        """
+        with no_escaping():
+            process = self.prep_bare(
+                "/bin/bash",
+                "-c",
+                f"source /etc/profile\n{script}"
+            ).popen(stdin=subprocess.DEVNULL)
+
+        stdout = stdout_sink or io.BytesIO()
+        stderr = stderr_sink or io.BytesIO()
+        # Pipes are always set up by popen.
+        _pump({cast(IO[bytes], process.stdout).fileno(): stdout,
+               cast(IO[bytes], process.stderr).fileno(): stderr})
+        retcode = process.wait()
+
+        def text(output: BinaryIO) -> str:
+            if isinstance(output, io.BytesIO):
+                return output.getvalue().decode("utf-8", errors="replace")
+            return ""
+
+        return (retcode, text(stdout), text(stderr))
+
+
+class StepResult(NamedTuple):
+    name: str
+    # None if the step wasn't run.
+    retcode: Optional[int]
+    output: str
+
+
+class BatchError(GeniException):
+    def __init__(self, results: List[StepResult], stderr: str) -> None:
+        failed = [result
+                  for result in results
+                  if result.retcode not in (0, None)]
+        if failed:
+            message = (f"Step {failed[0].name} failed with exit code "
+                       f"{failed[0].retcode}")
+        else:
+            message = "Batch of chroot commands failed"
+        super().__init__(message)
+        self.results = results
+        self.stderr = stderr
+
+
+class ChrootBatch:
+    """Commands queued to be run in order by a single shell within a single
+    chroot session, stopping at the first one which fails.
+
+    Every command is run in a subshell, followed by end marker with its
+    return code, so that its output and result can be told apart.
+    """
+    def __init__(self, chroot_: 'Chroot') -> None:
+        self.chroot = chroot_
+        self.steps: List[Tuple[str, str]] = []
+
+    def add(self, name: str, *args, env_vars={}) -> None:
+        self.steps.append((name, ChrootExec.make_command(args, env_vars)))
+
+    def add_shell(self, name: str, command: str) -> None:
+        """Queues shell command, unquoted."""
+        self.steps.append((name, command))
+
+    def run(self, stream: bool = False) -> List[StepResult]:
+        """Runs queued commands, passing their output through to stdout and
+        stderr if `stream` is set.
+
+        :raises BatchError: If any command fails.
+        """
+        if not self.steps:
+            return []
+
+        token = uuid.uuid4().hex
+        script = "\n".join(f"( {command} ) </dev/null; retcode=$?; "
+                           f"{_mark_end(token)}; "
+                           f"[ $retcode -eq 0 ] || exit $retcode"
+                           for _, command in self.steps)
+        output = _MarkedOutput(token, sys.stdout.buffer if stream else None)
+        with self.chroot as chroot_exec:
+            retcode, _, stderr = chroot_exec.run_script(
+                script,
+                stdout_sink=cast(BinaryIO, output),
+                stderr_sink=sys.stderr.buffer if stream else None)
+
+        results = [StepResult(name,
+                              (output.retcodes[index]
+                               if index < len(output.retcodes)
+                               else None),
+                              output.text(index))
+                   for index, (name, _) in enumerate(self.steps)]
+        self.steps = []
+        for result in results:
+            logging.debug("Step %s: %s", result.name, result.retcode)
+        if retcode != 0:
+            raise BatchError(results, stderr)
+        return results
+
+
+class ChrootAgent:
+    """Long-lived shell in chroot which sources /etc/profile once and runs
+    commands sent to it over a pipe, each in a subshell.
+
+    Saves spawning sudo, chroot and bash, and sourcing profile, for every
+    command. Commands run this way don't get stdin.
+    """
+    def __init__(self, chroot_exec: ChrootExec) -> None:
+        self.chroot_exec = chroot_exec
+        self.token = uuid.uuid4().hex
+        self.process: Optional[subprocess.Popen] = None
+        self.lock = threading.Lock()
+
+    def _start(self) -> subprocess.Popen:
+        logging.debug("Starting chroot agent")
+        process = self.chroot_exec.prep_bare("/bin/bash",
+                                             "--noprofile",
+                                             "--norc",
+                                             "-s").popen()
+        process.stdin.write(b"source /etc/profile\n")
+        return process
+
+    def stop(self) -> None:
+        with self.lock:
+            if self.process is not None:
+                self.process.communicate()
+                self.process = None
+
+    def run(self,
+            command: str,
+            stdout_sink: Optional[BinaryIO] = None,
+            stderr_sink: Optional[BinaryIO] = None) -> Tuple[int, str, str]:
+        """Runs shell command. Output is passed on to sinks as it comes, if
+        they're given, instead of being returned.
+
+        :return: Return code, stdout and stderr.
+        """
+        end = _mark_end(self.token)
+        script = (f"( {command} ) </dev/null; retcode=$?; "
+                  f"{end}; {end} >&2\n")
+
+        with self.lock:
+            if self.process is None:
+                self.process = self._start()
+            # Pipes are always set up by popen.
+            stdin = cast(IO[bytes], self.process.stdin)
+            stdout_pipe = cast(IO[bytes], self.process.stdout)
+            stderr_pipe = cast(IO[bytes], self.process.stderr)
+            stdin.write(script.encode())
+            stdin.flush()
+
+            stdout = _MarkedOutput(self.token, stdout_sink)
+            stderr = _MarkedOutput(self.token, stderr_sink)
+            if not _pump({stdout_pipe.fileno(): cast(BinaryIO, stdout),
+                          stderr_pipe.fileno(): cast(BinaryIO, stderr)},
+                         until=lambda: bool(stdout.retcodes
+                                            and stderr.retcodes)):
+                self.process = None
+                raise GeniException("Chroot agent exited unexpectedly")
+
+        return (stdout.retcodes[0], stdout.text(), stderr.text())
+
+
+class AgentChrootExec(ChrootExec):
+    """Runs commands through `ChrootAgent`, except for background ones,
+    commands reading stdin and shell.
+    """
+    def __init__(self, chroot_exec: ChrootExec) -> None:
+        super().__init__(chroot_exec.chroot_dir)
+        self.chroot_exec = chroot_exec
+        self.agent = ChrootAgent(chroot_exec)
+
+    def prep_bare(self, *args):
+        return self.chroot_exec.prep_bare(*args)
+
+    def _run(self, args, env_vars, stream: bool) -> str:
+        retcode, stdout, stderr = self.agent.run(
+            self.make_command(args, env_vars),
+            sys.stdout.buffer if stream else None,
+            sys.stderr.buffer if stream else None)
+        if retcode != 0:
+            raise ProcessExecutionError(list(args), retcode, stdout, stderr)
+        return stdout
+
+    def __call__(self, *args, env_vars={}):
+        return self._run(args, env_vars, stream=False)
+
+    def fg(self, *args, env_vars={}):  # pylint: disable=invalid-name
+        self._run(args, env_vars, stream=True)
+
+    def run_script(self,
+                   script: str,
+                   stdout_sink: Optional[BinaryIO] = None,
+                   stderr_sink: Optional[BinaryIO] = None
+                   ) -> Tuple[int, str, str]:
+        return self.agent.run(script, stdout_sink, stderr_sink)
+
+    def close(self) -> None:
+        self.agent.stop()
+
+
+class PrivateChrootExec(ChrootExec):
+    """Runs every command in its own mount namespace, mounting chroot file
+    systems there first. Mounts are private to the command and released by
+    kernel when it exits.
+    """
+    def __init__(self,
+                 chroot_dir: str,
+                 setup_commands: Sequence[Sequence[str]]) -> None:
+        super().__init__(chroot_dir)
+        self.setup_script = make_script(setup_commands)
+
+    def prep_bare(self, *args):
+        # Arguments are passed as they are, not through nested plumbum
+        # commands, so they don't need escaping.
+        return sudo["unshare", "--mount", "--propagation", "private",
+                    "sh", "-e", "-c", f'{self.setup_script}\n'
+                                      'exec chroot "$@"',
+                    "geni-chroot", self.chroot_dir, *args]
+
 
 class Chroot:
-    def __init__(self, chroot_dir: str, work_dir: str) -> None:
+    """Chroot with file systems mounted as long as any session is in.
+
+    Whichever session comes in first mounts them and whichever leaves last
+    unmounts them. Sessions hold a shared lock on sessions lock file while
+    they're in, so one can wait for the others to leave.
+
+    Mounts are recorded in a journal, so the first session in can clean up
+    mounts left by sessions which were killed, and the last one out
+    unmounts what's recorded, whichever session mounted it. Sessions joining
+    mount what they need and isn't mounted yet.
+
+    Host's /etc/resolv.conf and `inject_files` are put into chroot along
+    with mounting it. `shared_caches` are bind mounted, held by every
+    session in. Builds take place in tmpfs of `portage_tmpfs_size` bytes if
+    it's set.
+    """
+    def __init__(self,
+                 chroot_dir: str,
+                 work_dir: str,
+                 session_timeout: Optional[float] = None,
+                 use_agent: bool = False,
+                 inject_files: Sequence[str] = (),
+                 shared_caches: Sequence[SharedCache] = (),
+                 portage_tmpfs_size: Optional[int] = None) -> None:
         self.chroot_dir = chroot_dir
-        self.mounts_mgr = MountsManager(self.chroot_dir)
         chroot_name = os.path.basename(chroot_dir)
         chroot_path_hash = hash_path(chroot_dir)
-        self.semaphore = FileSemaphore(
-            os.path.join(work_dir,
-                         f"._geni_chroot_{chroot_name}_{chroot_path_hash}_cnt")
-        )
-        self.resolv_conf = FileTempInst(
+        base_path = os.path.join(
+            work_dir,
+            f"._geni_chroot_{chroot_name}_{chroot_path_hash}")
+        self.mount_journal = MountJournal(f"{base_path}_mounts.json")
+        self.mounts_mgr = MountsManager(self.chroot_dir,
+                                        self.mount_journal,
+                                        shared=True)
+        self.semaphore = FileSemaphore(f"{base_path}_cnt")
+        self.sessions_lock_path = f"{base_path}_sessions.lock"
+        self.session_timeout = session_timeout
+        self.session_lock: Optional[IO] = None
+        self.host_files = HostFiles(
             self.chroot_dir,
-            "/etc/resolv.conf"
-        )
-        self.master = False
+            ["/etc/resolv.conf", *inject_files],
+            InstallManifest(f"{base_path}_host_files.json"))
+        self.shared_caches = list(shared_caches)
+        self.shared_cache_locks: List[IO] = []
+        self.portage_tmpfs_size = portage_tmpfs_size
+        self.joined = False
+        self.use_agent = use_agent
+        self.agent_exec: Optional[AgentChrootExec] = None
 
-    def clean_up(self) -> None:
-        self.semaphore.down()
+    def batch(self) -> ChrootBatch:
+        return ChrootBatch(self)
+
+    def make_exec(self, chroot_exec: ChrootExec) -> ChrootExec:
+        """Wraps `chroot_exec` to run commands through an agent if enabled.
+        The agent is stopped on clean up.
+        """
+        if not self.use_agent:
+            return chroot_exec
+        self.agent_exec = AgentChrootExec(chroot_exec)
+        return self.agent_exec
+
+    def _recover(self) -> None:
+        recovered = self.mount_journal.recover()
+        if recovered:
+            logging.warning("Cleaned up %d mounts left by killed sessions",
+                            len(recovered))
 
-        if self.master:
-            while self.semaphore.get() > 0:
-                # log warning?
-                time.sleep(3)
+    def recover(self) -> bool:
+        """Cleans up mounts left by killed sessions, unless any session is
+        in.
 
+        :return: False if skipped because of sessions in.
+        """
+        return self.semaphore.run_if_idle(self._recover)
+
+    def _set_up(self) -> None:
+        self._recover()
+        try:
+            self.mount_all()
+        except:  # noqa: E722
             exc_eater = ExceptionEater()
-            exc_eater.eat(self.umount_all)
-            exc_eater.eat(self.resolv_conf.remove)
-            self.master = False
-            exc_eater.raise_first_if_any()
+            exc_eater.eat(self.mounts_mgr.umount_all)
+            exc_eater.eat(self.host_files.remove)
+            raise
 
-    @staticmethod
-    def ensure_all_mounted() -> None:
-        for mp_path in ["/tmp", "/proc", "/sys", "/dev"]:
-            mountpoint["-q", mp_path]()
+    def _join(self) -> None:
+        """Mounts and puts host files into chroot which sessions already in
+        haven't, e.g. shared caches, tmpfs or files of options they weren't
+        given.
+        """
+        mount_points = read_mount_points()
+        recorded = {mount_.mount_point: mount_.device
+                    for mount_ in self.mount_journal.mounts(shared_only=True)}
+        missing = []
+        for mount_ in self.make_mounts():
+            if not mount_.is_mounted(mount_points):
+                missing.append(mount_)
+            elif recorded.get(mount_.mount_point,
+                              mount_.device) != mount_.device:
+                raise GeniException(
+                    f"{mount_.mount_point} is mounted from "
+                    f"{recorded[mount_.mount_point]} by another session, "
+                    f"not {mount_.device}")
+        if missing:
+            logging.info("Mounting for this session: %s",
+                         ", ".join(mount_.mount_point for mount_ in missing))
+        missing_files = self.host_files.missing()
+        if missing_files:
+            logging.info("Putting into chroot for this session: %s",
+                         ", ".join(missing_files))
+        self.mounts_mgr.add_all(
+            missing,
+            extra_commands=self.host_files.install_commands(missing_files))
 
-    def mount_all(self) -> None:
-        self.mounts_mgr.mount("geni_tmpfs", "/tmp", "--types", "tmpfs")
+    def _tear_down(self) -> None:
+        exc_eater = ExceptionEater()
+        _, error = exc_eater.eat(self.umount_all,
+                                 self.host_files.remove_commands())
+        if error is None:
+            self.host_files.forget()
+        else:
+            exc_eater.eat(self.host_files.remove)
+        exc_eater.raise_first_if_any()
+
+    def _hold_shared_caches(self) -> None:
+        for cache in self.shared_caches:
+            self.shared_cache_locks.append(cache.hold())
+
+    def clean_up(self) -> None:
+        try:
+            if self.agent_exec is not None:
+                self.agent_exec.close()
+                self.agent_exec = None
+            if self.joined:
+                self.joined = False
+                self.semaphore.down(on_last=self._tear_down)
+        finally:
+            if self.session_lock is not None:
+                self.session_lock.close()
+                self.session_lock = None
+            while self.shared_cache_locks:
+                self.shared_cache_locks.pop().close()
+
+    def wait_for_other_sessions(self) -> bool:
+        """Blocks until all the other sessions leave or `session_timeout`
+        passes. Meant to be called after leaving the chroot.
+
+        :return: False if timed out.
+        """
+        with open(self.sessions_lock_path, "a") as lock_file:
+            return flock_waiting(lock_file,
+                                 fcntl.LOCK_EX,
+                                 self.session_timeout)
+
+    def ensure_all_mounted(self) -> None:
+        mount_points = read_mount_points()
+        missing = [mount_.mount_point
+                   for mount_ in self.make_mounts()
+                   if not mount_.is_mounted(mount_points)]
+        if missing:
+            raise GeniException(f"Not mounted: {', '.join(missing)}")
+
+    def make_mounts(self) -> List[Mount]:
+        make_mount = self.mounts_mgr.make_mount
+        return [
+            make_mount("geni_tmpfs", "/tmp", "--types", "tmpfs"),
+            make_mount("/proc", "/proc", "--types", "proc",
+                       make_rslave=True),
+            make_mount("/sys", "/sys", "--rbind", make_rslave=True),
+            make_mount("/dev", "/dev", "--rbind", make_rslave=True),
+            *(cache.make_mount(self.chroot_dir)
+              for cache in self.shared_caches),
+            *self._make_portage_tmpfs_mounts(),
+        ]
 
+    def _make_portage_tmpfs_mounts(self) -> List[Mount]:
+        if self.portage_tmpfs_size is None:
+            return []
+        return [self.mounts_mgr.make_mount(
+            "geni_portage_tmpfs",
+            PORTAGE_TMPFS_DIR,
+            "--types", "tmpfs",
+            "-o", f"size={self.portage_tmpfs_size},mode=0775",
+            create_mount_point=True)]
+
+    def _put_missing_host_files(self) -> None:
+        put = self.host_files.put_missing()
+        if put:
+            logging.info("Put into chroot: %s", ", ".join(put))
+
+    def private_exec(self,
+                     mounts: Sequence[Mount] = (),
+                     extra_commands: Sequence[Sequence[str]] = ()
+                     ) -> PrivateChrootExec:
+        """Makes executor of commands in private mount namespaces, with
+        `mounts`, chroot file systems and host files mounted, then
+        `extra_commands` run as root.
+
+        Host files are bind mounted read-only over files in chroot, so
+        nothing is written back to host. Ones missing in chroot, e.g.
+        /etc/resolv.conf which stage3 doesn't ship, are first written into
+        it for good, as there's nothing to mount them over otherwise.
+
+        No session is joined, but shared caches are held until clean up.
+        """
         if os.path.islink("/dev/shm"):
             raise GeniException("/dev/shm is not a directory")
 
-        self.mounts_mgr.mount("/proc", "/proc", "--types", "proc",
-                              make_rslave=True)
-        self.mounts_mgr.mount("/sys", "/sys", "--rbind",
-                              make_rslave=True)
-        self.mounts_mgr.mount("/dev", "/dev", "--rbind",
-                              make_rslave=True)
+        self._hold_shared_caches()
+        self.semaphore.run_exclusive(self._put_missing_host_files)
 
-    def umount_all(self) -> None:
-        self.mounts_mgr.umount_all()
+        commands: List[Sequence[str]] = [
+            command
+            for mount_ in [*mounts, *self.make_mounts()]
+            for command in mount_.mount_commands()
+        ]
+        for path in self.host_files.paths:
+            target_path = self.host_files.target_path(path)
+            # Symlink would be followed outside of chroot.
+            if (os.path.islink(target_path)
+                    or not os.path.isfile(target_path)):
+                raise GeniException(f"Not a regular file, can't bind mount "
+                                    f"host file over it: {target_path}")
+            commands.extend(BindMount(path,
+                                      target_path,
+                                      read_only=True).mount_commands())
+        commands.extend(extra_commands)
+        return PrivateChrootExec(self.chroot_dir, commands)
+
+    def mount_all(self) -> None:
+        if os.path.islink("/dev/shm"):
+            raise GeniException("/dev/shm is not a directory")
+
+        host_files_commands = self.host_files.install_commands()
+        self.mounts_mgr.add_all(self.make_mounts(),
+                                extra_commands=host_files_commands)
+
+    def umount_all(self,
+                   extra_commands: Sequence[Sequence[str]] = ()) -> None:
+        # Some may have been mounted by sessions which have already left,
+        # with options other than this one's.
+        self.mounts_mgr.adopt_recorded()
+        self.mounts_mgr.umount_all(extra_commands=extra_commands)
 
     def prepare(self) -> None:
-        if self.semaphore.up() == 1:
-            self.master = True
-            self.resolv_conf.copy()
-            self.mount_all()
-        else:
-            assert self.semaphore.get() > 1
+        self.session_lock = open(self.sessions_lock_path, "a")
+        fcntl.flock(self.session_lock, fcntl.LOCK_SH)
+        self._hold_shared_caches()
+
+        self.semaphore.up(on_first=self._set_up, on_join=self._join)
+        self.joined = True
 
-        self.resolv_conf.ensure_is_copied()
+        self.host_files.refresh()
         self.ensure_all_mounted()
 
     def __enter__(self) -> ChrootExec:
@@ -125,7 +667,7 @@ class Chroot:
         except:  # noqa: E722
             self.clean_up()
             raise
-        return ChrootExec(self.chroot_dir)
+        return self.make_exec(ChrootExec(self.chroot_dir))
 
     def __exit__(self,
                  exception_type: Type[Exception],
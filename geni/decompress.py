@@ -0,0 +1,91 @@
+import logging
+from typing import List, NamedTuple, Optional, Tuple
+
+from plumbum import CommandNotFound, local
+
+from .exceptions import GeniException
+
+
+class Decompressor(NamedTuple):
+    name: str
+    extension: str
+    command: Tuple[str, ...]
+
+
+# Ordered by preference within the same extension.
+DECOMPRESSORS = [
+    Decompressor("pixz", ".xz", ("pixz",)),
+    Decompressor("xz", ".xz", ("xz", "-T0")),
+    Decompressor("pzstd", ".zst", ("pzstd",)),
+    Decompressor("zstd", ".zst", ("zstd", "-T0")),
+    Decompressor("pigz", ".gz", ("pigz",)),
+    Decompressor("lbzip2", ".bz2", ("lbzip2",)),
+    Decompressor("pbzip2", ".bz2", ("pbzip2",)),
+]
+
+# Single-threaded programs used when tar can't detect compression itself,
+# i.e. when the archive is read from a pipe.
+PLAIN_DECOMPRESSORS = {
+    ".xz": "xz",
+    ".zst": "zstd",
+    ".gz": "gzip",
+    ".bz2": "bzip2",
+}
+
+DECOMPRESSOR_CHOICES = ["auto", "tar"] + [d.name for d in DECOMPRESSORS]
+
+
+def _archive_extension(archive_name: str) -> str:
+    for extension in PLAIN_DECOMPRESSORS:
+        if archive_name.endswith(extension):
+            return extension
+    raise GeniException(f"Unknown compression of archive: {archive_name}")
+
+
+def _resolve(decompressor: Decompressor) -> Optional[str]:
+    program, *args = decompressor.command
+    try:
+        program_path = str(local.which(program))
+    except CommandNotFound:
+        return None
+    return " ".join([program_path] + args)
+
+
+def find_decompressor(archive_name: str,
+                      choice: str = "auto",
+                      from_pipe: bool = False) -> Optional[str]:
+    """Finds program for tar's `--use-compress-program` option.
+
+    :param archive_name: Name of the archive, used to tell its compression.
+    :param choice: Name of decompressor to force, "auto" to pick the best
+        available one or "tar" to let tar decompress on its own.
+    :param from_pipe: Whether archive is going to be read from a pipe.
+    :return: Decompressor command or None if tar should handle compression
+        on its own.
+    """
+    extension = _archive_extension(archive_name)
+
+    if choice == "tar":
+        return PLAIN_DECOMPRESSORS[extension] if from_pipe else None
+
+    candidates: List[Decompressor] = [
+        decompressor
+        for decompressor in DECOMPRESSORS
+        if decompressor.extension == extension
+        and choice in ("auto", decompressor.name)
+    ]
+    if choice != "auto" and not candidates:
+        raise GeniException(f"Decompressor {choice} can't decompress "
+                            f"{archive_name}")
+
+    for decompressor in candidates:
+        command = _resolve(decompressor)
+        if command:
+            logging.debug("Using %s to decompress %s", command, archive_name)
+            return command
+
+    if choice != "auto":
+        raise GeniException(f"Decompressor not found: {choice}")
+
+    logging.info("No parallel decompressor found for %s", archive_name)
+    return PLAIN_DECOMPRESSORS[extension] if from_pipe else None
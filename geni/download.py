@@ -1,63 +1,490 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import json
 import logging
+import os
 import os.path
 import re
-from typing import Dict, TextIO
+import threading
+import time
+from typing import (Callable,
+                    Dict,
+                    List,
+                    NamedTuple,
+                    Optional,
+                    Sequence,
+                    Set,
+                    TextIO,
+                    Tuple,
+                    TypeVar)
 
 import requests
 
+from .exceptions import GeniException
+from .transport import Session, TransportConfig
 from .util import join_url
 
 
-class Downloader:
-    CHUNK_SIZE = 10240
+class DownloadError(GeniException):
+    pass
 
-    def __init__(self, base_url: str) -> None:
-        self.base_url = base_url
-        self.session = requests.Session()
 
-    def join_url(self, path: str) -> str:
-        return join_url(self.base_url, path)
+Consumer = Callable[[bytes], None]
+T = TypeVar("T")  # pylint: disable=invalid-name
 
-    def download_into(self, remote_path: str, local_path: str) -> None:
-        if os.path.exists(local_path):
-            raise FileExistsError(local_path)
 
-        response = self.session.get(self.join_url(remote_path), stream=True)
+def make_segments(start: int,
+                  end: int,
+                  segment_size: int) -> List[Tuple[int, int]]:
+    return [(offset, min(offset + segment_size, end))
+            for offset in range(start, end, segment_size)]
+
+
+def pwrite_all(fd: int, data: bytes, offset: int) -> None:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+class RemoteFile(NamedTuple):
+    path: str
+    size: Optional[int]
+    accepts_ranges: bool
+    mirror_index: int
+
+
+class Segment:
+    def __init__(self, start: int, end: int) -> None:
+        self.start = start
+        self.end = end
+        self.offset = start
+
+
+class RangeJournal:
+    """Sidecar of a partial download listing byte ranges already on disk.
+
+    The journal is bound to the size and validator of the remote file, so
+    it is discarded when the remote file changes. Release files are never
+    modified in place, so their remote path is a validator good across
+    mirrors, unlike ETag. It's discarded as well when the partial file
+    isn't there or isn't of the remote file size, as ranges it lists
+    aren't on disk then.
+    """
+    def __init__(self, path: str, size: int, validator: str) -> None:
+        self.path = path
+        self.size = size
+        self.validator = validator
+        self.ranges: List[Tuple[int, int]] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls,
+             path: str,
+             size: int,
+             validator: str,
+             part_path: str) -> 'RangeJournal':
+        journal = cls(path, size, validator)
+        try:
+            with open(path, "r") as journal_file:
+                content = json.load(journal_file)
+        except (FileNotFoundError, ValueError):
+            return journal
+
+        try:
+            part_size: Optional[int] = os.path.getsize(part_path)
+        except FileNotFoundError:
+            part_size = None
+
+        if (content.get("size") != size
+                or content.get("validator") != validator):
+            logging.info("Remote file changed, discarding partial download: "
+                         "%s", path)
+        elif part_size != size:
+            logging.info("Partial file missing or of wrong size, discarding "
+                         "partial download: %s", path)
+        else:
+            journal.ranges = [(start, end)
+                              for start, end in content.get("ranges", [])]
+        return journal
+
+    def _save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as journal_file:
+            json.dump({"size": self.size,
+                       "validator": self.validator,
+                       "ranges": self.ranges},
+                      journal_file)
+        os.replace(tmp_path, self.path)
+
+    def add(self, start: int, end: int) -> None:
+        with self._lock:
+            merged: List[Tuple[int, int]] = []
+            for range_start, range_end in sorted(self.ranges + [(start, end)]):
+                if merged and range_start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+                else:
+                    merged.append((range_start, range_end))
+            self.ranges = merged
+            self._save()
+
+    def contiguous_end(self) -> int:
+        with self._lock:
+            if self.ranges and self.ranges[0][0] == 0:
+                return self.ranges[0][1]
+            return 0
+
+    def missing(self) -> List[Tuple[int, int]]:
+        gaps = []
+        offset = 0
+        for start, end in self.ranges:
+            if start > offset:
+                gaps.append((offset, start))
+            offset = max(offset, end)
+        if offset < self.size:
+            gaps.append((offset, self.size))
+        return gaps
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class OrderedFeeder:
+    """Feeds consumers in order with content of a file written out of order.
+
+    Content is read back (typically from the page cache) as soon as the
+    contiguous part from the beginning of the file grows.
+    """
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, path: str, consumers: Sequence[Consumer]) -> None:
+        self.path = path
+        self.consumers = consumers
+        self.offset = 0
+        self._lock = threading.Lock()
+
+    def advance(self, end: int) -> None:
+        if not self.consumers:
+            return
+
+        with self._lock:
+            if end <= self.offset:
+                return
+            with open(self.path, "rb") as file:
+                file.seek(self.offset)
+                while self.offset < end:
+                    chunk = file.read(min(self.READ_SIZE, end - self.offset))
+                    if not chunk:
+                        raise DownloadError(f"Unexpected end of {self.path}")
+                    for consume in self.consumers:
+                        consume(chunk)
+                    self.offset += len(chunk)
+
+
+class StoredDigests:
+    """Digests of a local file kept in a sidecar file next to it.
+
+    Stored digests are valid as long as size and modification time of the
+    file don't change, which saves re-hashing big files on every run.
+    """
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.path = f"{file_path}.digests"
+
+    def _stat_key(self) -> Tuple[int, int]:
+        file_stat = os.stat(self.file_path)
+        return (file_stat.st_size, file_stat.st_mtime_ns)
+
+    def _load(self) -> Dict[str, str]:
+        try:
+            with open(self.path, "r") as digests_file:
+                content = json.load(digests_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+        stat_key = [content.get("size"), content.get("mtime_ns")]
+        if stat_key != list(self._stat_key()):
+            return {}
+        return content.get("hashes", {})
+
+    def get(self, hash_name: str) -> Optional[str]:
+        return self._load().get(hash_name)
+
+    def put(self, hash_name: str, digest: str) -> None:
+        hashes = self._load()
+        hashes[hash_name] = digest.lower()
+        size, mtime_ns = self._stat_key()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as digests_file:
+            json.dump({"size": size, "mtime_ns": mtime_ns, "hashes": hashes},
+                      digests_file)
+        os.replace(tmp_path, self.path)
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Downloader:
+    """Downloads files from a list of mirrors.
 
-        with open(local_path, 'wb') as local_file:
+    Mirrors are tried in order, the next one taking over when a mirror
+    fails or stalls. Ranged download may spread its segments over first
+    `spread` mirrors.
+    """
+    CHUNK_SIZE = 10240
+    SEGMENT_SIZE = 16 * 1024 * 1024
+
+    def __init__(self,
+                 base_urls: Sequence[str],
+                 connections: int = 1,
+                 segment_size: int = SEGMENT_SIZE,
+                 spread: int = 1,
+                 session: Optional[requests.Session] = None) -> None:
+        if not base_urls:
+            raise ValueError("No mirrors to download from")
+        self.base_urls = list(base_urls)
+        self.connections = max(1, connections)
+        self.segment_size = max(self.CHUNK_SIZE, segment_size)
+        self.spread = max(1, min(spread, len(self.base_urls)))
+        self.session = session or Session(
+            TransportConfig(pool_size=self.connections))
+        self._cancelled = threading.Event()
+
+    def join_url(self, path: str, mirror_index: int = 0) -> str:
+        base_url = self.base_urls[mirror_index % len(self.base_urls)]
+        return join_url(base_url, path)
+
+    def _get(self, url: str, **kwargs) -> requests.Response:
+        response = self.session.get(url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def _head(self, url: str) -> requests.Response:
+        response = self.session.head(url, allow_redirects=True)
+        response.raise_for_status()
+        return response
+
+    def _with_failover(self,
+                       path: str,
+                       request: Callable[[str], T],
+                       first_mirror: int = 0) -> Tuple[T, int]:
+        error: Optional[Exception] = None
+        for attempt in range(len(self.base_urls)):
+            mirror_index = (first_mirror + attempt) % len(self.base_urls)
+            url = self.join_url(path, mirror_index)
+            try:
+                return (request(url), mirror_index)
+            except (requests.RequestException, DownloadError) as exception:
+                if self._cancelled.is_set():
+                    raise
+                logging.warning("Failed to fetch %s: %s", url, exception)
+                error = exception
+        raise DownloadError(f"No mirror could serve {path}: {error}")
+
+    def _probe(self, remote_path: str) -> RemoteFile:
+        response, mirror_index = self._with_failover(remote_path, self._head)
+
+        try:
+            size: Optional[int] = int(response.headers["Content-Length"])
+        except (KeyError, ValueError):
+            size = None
+        accepts_ranges = (
+            response.headers.get("Accept-Ranges", "").lower() == "bytes")
+        return RemoteFile(remote_path, size, accepts_ranges, mirror_index)
+
+    def _download_stream(self,
+                         remote_file: RemoteFile,
+                         part_path: str,
+                         consumers: Sequence[Consumer]) -> None:
+        response = self._get(self.join_url(remote_file.path,
+                                           remote_file.mirror_index),
+                             stream=True)
+
+        with open(part_path, 'wb') as part_file:
             for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
                 if chunk:  # Filter out keep-alive new chunks.
-                    local_file.write(chunk)
+                    part_file.write(chunk)
+                    for consume in consumers:
+                        consume(chunk)
+
+    def _fetch_segment(self,
+                       url: str,
+                       part_fd: int,
+                       segment: Segment) -> None:
+        headers = {"Range": f"bytes={segment.offset}-{segment.end - 1}"}
+        response = self._get(url, headers=headers, stream=True)
+        if response.status_code != requests.codes.partial_content:
+            raise DownloadError(f"Range request not honoured: {url}")
+
+        for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+            if self._cancelled.is_set():
+                raise DownloadError(f"Download cancelled: {url}")
+            if chunk:  # Filter out keep-alive new chunks.
+                pwrite_all(part_fd, chunk, segment.offset)
+                segment.offset += len(chunk)
+
+        if segment.offset != segment.end:
+            raise DownloadError(f"Segment {segment.start}-{segment.end} of "
+                                f"{url} ended prematurely at "
+                                f"{segment.offset}")
+
+    def _download_segment(self,
+                          remote_path: str,
+                          part_fd: int,
+                          segment: Segment,
+                          first_mirror: int,
+                          on_complete: Callable[[int, int], None]) -> None:
+        # Each attempt continues from where the previous mirror stopped.
+        self._with_failover(
+            remote_path,
+            lambda url: self._fetch_segment(url, part_fd, segment),
+            first_mirror)
+
+        os.fdatasync(part_fd)
+        on_complete(segment.start, segment.end)
+
+    def _download_ranged(self,
+                         remote_file: RemoteFile,
+                         part_path: str,
+                         consumers: Sequence[Consumer]) -> None:
+        size = remote_file.size or 0
+        journal = RangeJournal.load(f"{part_path}.ranges",
+                                    size,
+                                    remote_file.path,
+                                    part_path)
+        segments = [Segment(start, end)
+                    for gap_start, gap_end in journal.missing()
+                    for start, end in make_segments(gap_start, gap_end,
+                                                    self.segment_size)]
+        if journal.ranges:
+            logging.info("Resuming partial download: %s", part_path)
+        logging.debug("Downloading %s in %d segments over %d connections "
+                      "from %d mirrors",
+                      remote_file.path, len(segments), self.connections,
+                      self.spread)
+
+        feeder = OrderedFeeder(part_path, consumers)
+
+        def on_complete(start: int, end: int) -> None:
+            journal.add(start, end)
+            feeder.advance(journal.contiguous_end())
+
+        part_fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self._cancelled.clear()
+        try:
+            os.ftruncate(part_fd, size)
+            if size:
+                os.posix_fallocate(part_fd, 0, size)
+            with ThreadPoolExecutor(max_workers=self.connections) as pool:
+                futures = [pool.submit(self._download_segment,
+                                       remote_file.path, part_fd, segment,
+                                       (remote_file.mirror_index
+                                        + index % self.spread),
+                                       on_complete)
+                           for index, segment in enumerate(segments)]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    self._cancelled.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(part_fd)
+
+        feeder.advance(size)
+        journal.remove()
+
+    def download_into(self,
+                      remote_path: str,
+                      local_path: str,
+                      consumers: Sequence[Consumer] = ()) -> None:
+        """Downloads remote file via `.part` file renamed to `local_path`
+        once complete.
+
+        Interrupted download is resumed if the server accepts ranges.
+        Consumers are fed with the whole file content in order while it is
+        being downloaded.
+        """
+        if os.path.exists(local_path):
+            raise FileExistsError(local_path)
+
+        part_path = f"{local_path}.part"
+        start_time = time.monotonic()
+        remote_file = self._probe(remote_path)
+
+        if remote_file.accepts_ranges and remote_file.size is not None:
+            self._download_ranged(remote_file, part_path, consumers)
+        else:
+            self._download_stream(remote_file, part_path, consumers)
+
+        os.replace(part_path, local_path)
+        logging.info("Downloaded %s: %.1f MiB in %.1f s",
+                     remote_path,
+                     os.path.getsize(local_path) / 2**20,
+                     time.monotonic() - start_time)
 
     def download_text(self, path: str) -> str:
-        response = self.session.get(self.join_url(path))
+        response, _mirror_index = self._with_failover(path, self._get)
         return response.text
 
 
 class StageDownloader:
-    def __init__(self, mirror_url: str, downloads_dir: str) -> None:
-        autobuilds_path = "releases/amd64/autobuilds"
-        self._downloader = Downloader(join_url(mirror_url, autobuilds_path))
+    AUTOBUILDS_PATH = "releases/amd64/autobuilds"
+    LATEST_STAGE_POINTER = "latest-stage3-amd64.txt"
+
+    def __init__(self,
+                 mirror_urls: Sequence[str],
+                 downloads_dir: str,
+                 connections: int = 1,
+                 segment_size: int = Downloader.SEGMENT_SIZE,
+                 spread: int = 1,
+                 session: Optional[requests.Session] = None) -> None:
+        self._downloader = Downloader([join_url(mirror_url,
+                                                self.AUTOBUILDS_PATH)
+                                       for mirror_url in mirror_urls],
+                                      connections=connections,
+                                      segment_size=segment_size,
+                                      spread=spread,
+                                      session=session)
         self.downloads_dir = downloads_dir
         os.makedirs(self.downloads_dir, exist_ok=True)
 
-    def _download(self, stage_remote_path: str, suffix: str) -> str:
+    def local_path(self, stage_remote_path: str, suffix: str = "") -> str:
         stage_file_name = os.path.basename(stage_remote_path)
-        target_file_path = os.path.join(self.downloads_dir,
-                                        f"{stage_file_name}{suffix}")
+        return os.path.join(self.downloads_dir, f"{stage_file_name}{suffix}")
+
+    def _download(self,
+                  stage_remote_path: str,
+                  suffix: str,
+                  hash_name: Optional[str] = None,
+                  consumers: Sequence[Consumer] = ()) -> str:
+        target_file_path = self.local_path(stage_remote_path, suffix)
+        hasher = hashlib.new(hash_name) if hash_name else None
+        all_consumers = list(consumers)
+        if hasher:
+            all_consumers.insert(0, hasher.update)
         try:
             self._downloader.download_into(f"{stage_remote_path}{suffix}",
-                                           target_file_path)
+                                           target_file_path,
+                                           consumers=all_consumers)
         except FileExistsError:
             logging.info("File already exists, skipping download: %s",
                          target_file_path)
+        else:
+            if hash_name and hasher:
+                StoredDigests(target_file_path).put(hash_name,
+                                                    hasher.hexdigest())
 
         return target_file_path
 
     def find_latest(self) -> str:
-        latest_stage_pointer = "latest-stage3-amd64.txt"
+        latest_stage_pointer = self.LATEST_STAGE_POINTER
         content = self._downloader.download_text(latest_stage_pointer)
         lines = [line
                  for line in content.split("\n")
@@ -81,12 +508,21 @@ class StageDownloader:
     def download_contents(self, stage_remote_path: str) -> str:
         return self._download(stage_remote_path, ".CONTENTS")
 
-    def download_stage(self, stage_remote_path: str) -> str:
-        return self._download(stage_remote_path, "")
+    def download_stage(self,
+                       stage_remote_path: str,
+                       hash_name: Optional[str] = None,
+                       consumers: Sequence[Consumer] = ()) -> str:
+        """Downloads stage tarball, hashing it on the fly with `hash_name`
+        algorithm if given and teeing its content into `consumers`.
+        """
+        return self._download(stage_remote_path, "", hash_name, consumers)
 
 
 class Digests:
     CHUNK_SIZE = 10240
+    # Fixed order, so the same algorithm keys caches and stored digests in
+    # every run.
+    HASH_PREFERENCE = ("blake2b", "sha512", "sha256", "sha1", "md5")
 
     hash_header = re.compile(r"^\s*#+\s*(?P<hash_name>\S+)\s+HASH\s*$")
     hash_line = re.compile(r"^(?P<hash>[a-fA-F0-9]+)\s+(?P<file_name>\S+)$")
@@ -135,11 +571,17 @@ class Digests:
         if not self.algorithms_available:
             raise ValueError("None of the following hashes are supported: {}"
                              .format(", ".join(all_hashes.keys())))
-        self.hash_name = next(iter(self.algorithms_available))
+        self.hash_name = self.preferred_hash(self.algorithms_available)
         self.hashes = all_hashes[self.hash_name]
 
-    def verify(self, file_name: str) -> bool:
-        expected_hash = self.hashes[os.path.abspath(file_name)]
+    @classmethod
+    def preferred_hash(cls, hash_names: Set[str]) -> str:
+        for hash_name in cls.HASH_PREFERENCE:
+            if hash_name in hash_names:
+                return hash_name
+        return sorted(hash_names)[0]
+
+    def _hash_file(self, file_name: str) -> str:
         hasher = hashlib.new(self.hash_name)
         with open(file_name, "rb") as file:
             while True:
@@ -147,5 +589,23 @@ class Digests:
                 if not chunk:
                     break
                 hasher.update(chunk)
-
-        return hasher.hexdigest().lower() == expected_hash
+        return hasher.hexdigest().lower()
+
+    def expected_hash(self, file_name: str) -> str:
+        return self.hashes[os.path.abspath(file_name)]
+
+    def verify(self, file_name: str, listed_as: Optional[str] = None) -> bool:
+        """Verifies file against digest listed for it or for `listed_as`
+        path if given.
+        """
+        expected_hash = self.expected_hash(listed_as or file_name)
+        stored_digests = StoredDigests(file_name)
+        actual_hash = stored_digests.get(self.hash_name)
+        if actual_hash is None:
+            actual_hash = self._hash_file(file_name)
+            stored_digests.put(self.hash_name, actual_hash)
+        else:
+            logging.debug("Using stored %s digest of %s",
+                          self.hash_name, file_name)
+
+        return actual_hash == expected_hash
@@ -0,0 +1,211 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import os.path
+from typing import Callable, Iterable, Iterator, List
+
+from plumbum.cmd import (cp,  # pylint: disable=import-error
+                         rm,
+                         sudo)
+
+from .mount import OverlayMount, read_overlay_lower_dirs
+from .util import hash_path, sibling_path
+
+CLONE_MODES = ["extract", "reflink", "overlay"]
+
+
+def _users_dir(golden_path: str) -> str:
+    return f"{golden_path}.users"
+
+
+class GoldenImages:
+    """Pristine extracted stage3 trees, one per release, to clone chroots
+    from.
+
+    Trees are keyed the same way as `ReleaseCache` entries. A tree is
+    complete once its `.ready` marker exists. Overlay clones register
+    themselves in the `.users` directory of the tree they're based on, as
+    the tree is their lower layer for as long as they exist.
+    """
+    def __init__(self, cache_dir: str) -> None:
+        self.golden_dir = os.path.join(cache_dir, "golden")
+        os.makedirs(self.golden_dir, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.golden_dir, key)
+
+    def _ready_marker(self, key: str) -> str:
+        return f"{self.path(key)}.ready"
+
+    def _lock_path(self, key: str) -> str:
+        return f"{self.path(key)}.lock"
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._ready_marker(key))
+
+    @contextmanager
+    def ensure(self,
+               key: str,
+               extract_into: Callable[[str], None]) -> Iterator[str]:
+        """Yields path of golden tree, extracting it first if needed.
+
+        The tree is created under an exclusive lock of its key, so
+        concurrent bootstraps of the same release extract it once, and it
+        stays locked shared until the block exits, so it isn't pruned while
+        being cloned.
+        """
+        path = self.path(key)
+        with open(self._lock_path(key), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("Waiting for golden image: %s", path)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if not self.exists(key):
+                logging.info("Creating golden image: %s", path)
+                os.makedirs(path, exist_ok=True)
+                extract_into(path)
+                with open(self._ready_marker(key), "w"):
+                    pass
+
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            yield path
+
+    def keys(self) -> List[str]:
+        return [file_name[:-len(".ready")]
+                for file_name in os.listdir(self.golden_dir)
+                if file_name.endswith(".ready")]
+
+    def in_use(self, key: str) -> bool:
+        """Tells whether tree is the lower layer of an overlay clone, either
+        registered or mounted.
+        """
+        path = self.path(key)
+        users_dir = _users_dir(path)
+        user_names = (os.listdir(users_dir)
+                      if os.path.isdir(users_dir) else [])
+        for user_name in user_names:
+            with open(os.path.join(users_dir, user_name), "r") as user_file:
+                record_path = user_file.read().strip()
+            if ChrootClone.lower_dir_of(record_path) == path:
+                return True
+
+        return any(os.path.realpath(lower_dir) == os.path.realpath(path)
+                   for lower_dir in read_overlay_lower_dirs())
+
+    def remove(self, key: str) -> None:
+        logging.info("Removing golden image: %s", self.path(key))
+        if self.exists(key):
+            os.remove(self._ready_marker(key))
+        sudo[rm["-rf", self.path(key), _users_dir(self.path(key))]]()
+
+    def prune(self, keep: Iterable[str]) -> List[str]:
+        """Removes golden trees of releases other than `keep`, skipping ones
+        which chroots are cloned from or based on.
+        """
+        keep = set(keep)
+        removed = []
+        for key in self.keys():
+            if key in keep:
+                continue
+            with open(self._lock_path(key), "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    logging.info("Keeping golden image being cloned: %s",
+                                 self.path(key))
+                    continue
+                if self.in_use(key):
+                    logging.info("Keeping golden image used by overlay "
+                                 "chroot: %s", self.path(key))
+                    continue
+                self.remove(key)
+                removed.append(key)
+        return removed
+
+
+class ChrootClone:
+    """Overlay clone of a golden tree mounted on a chroot directory.
+
+    The overlay outlives geni process, so it is recorded in work dir to be
+    mounted again e.g. after reboot.
+    """
+    def __init__(self, work_dir: str, chroot_dir: str) -> None:
+        self.chroot_dir = chroot_dir
+        chroot_name = os.path.basename(chroot_dir)
+        self.record_path = os.path.join(
+            work_dir,
+            f"._geni_clone_{chroot_name}_{hash_path(chroot_dir)}.json")
+        self.upper_dir = sibling_path(chroot_dir, "._upper_{}".format)
+        self.work_dir = sibling_path(chroot_dir, "._work_{}".format)
+
+    @staticmethod
+    def lower_dir_of(record_path: str) -> str:
+        """:return: Lower directory of recorded clone or empty string if
+            there's no record.
+        """
+        try:
+            with open(record_path, "r") as record_file:
+                return json.load(record_file)["lower_dir"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return ""
+
+    def _overlay(self, lower_dir: str) -> OverlayMount:
+        return OverlayMount(self.chroot_dir,
+                            self.upper_dir,
+                            lower_dir=lower_dir,
+                            work_dir=self.work_dir)
+
+    def _lower_dir(self) -> str:
+        with open(self.record_path, "r") as record_file:
+            return json.load(record_file)["lower_dir"]
+
+    def _user_path(self, lower_dir: str) -> str:
+        return os.path.join(_users_dir(lower_dir),
+                            os.path.basename(self.record_path))
+
+    def ensure_mounted(self) -> None:
+        if os.path.exists(self.record_path) \
+                and not os.path.ismount(self.chroot_dir):
+            logging.info("Mounting chroot overlay: %s", self.chroot_dir)
+            self._overlay(self._lower_dir()).mount()
+
+    def discard(self) -> None:
+        """Unmounts the overlay and drops its upper layer if there's one.
+        """
+        if not os.path.exists(self.record_path):
+            return
+
+        lower_dir = self._lower_dir()
+        if os.path.ismount(self.chroot_dir):
+            self._overlay(lower_dir).umount()
+        sudo[rm["-rf", self.upper_dir, self.work_dir]]()
+        os.remove(self.record_path)
+        try:
+            os.remove(self._user_path(lower_dir))
+        except FileNotFoundError:
+            pass
+
+    def clone_overlay(self, golden_path: str) -> None:
+        self.discard()
+        os.makedirs(self.upper_dir, exist_ok=True)
+        os.makedirs(_users_dir(golden_path), exist_ok=True)
+        with open(self._user_path(golden_path), "w") as user_file:
+            user_file.write(self.record_path)
+        self._overlay(golden_path).mount()
+        with open(self.record_path, "w") as record_file:
+            json.dump({"lower_dir": golden_path}, record_file)
+
+
+def clone_reflink(golden_path: str, chroot_dir: str) -> None:
+    """Copies golden tree into `chroot_dir` sharing data blocks where file
+    system supports it (btrfs, XFS), otherwise making a regular copy.
+    """
+    sudo[cp["-a",
+            "--reflink=auto",
+            "--no-target-directory",
+            golden_path,
+            chroot_dir]]()
@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 
 from plumbum import local
 from plumbum.cmd import gpg  # pylint: disable=import-error
@@ -25,8 +26,12 @@ class GpgAside:
             return output[0] == 0
 
     def recv_keys(self, *pub_key_ids: str) -> bool:
-        return all([self._call("--recv-key", pub_key_id)
-                    for pub_key_id in pub_key_ids])
+        start_time = time.monotonic()
+        received = all([self._call("--recv-key", pub_key_id)
+                        for pub_key_id in pub_key_ids])
+        logging.debug("Receiving GPG keys took %.0f ms",
+                      (time.monotonic() - start_time) * 1000)
+        return received
 
     def import_pub_keys(self, *pub_key_paths: str) -> bool:
         return all([self._call("--import", path)
@@ -0,0 +1,137 @@
+import logging
+import os
+import os.path
+import stat
+from typing import List, Optional, Sequence
+
+from .install import InstallManifest
+from .util import file_digest, sudo_script
+
+BACKUP_SUFFIX = ".geni-orig"
+NEW_SUFFIX = ".geni-new"
+
+
+class HostFiles:
+    """Host files put into chroot for as long as sessions are in, e.g.
+    /etc/resolv.conf.
+
+    Files are written atomically and chroot originals are kept aside with
+    `BACKUP_SUFFIX`, to be put back on removal. Commands are meant to be run
+    as root in the same script which mounts or unmounts the chroot.
+
+    Files put into chroot are recorded in `manifest`, so they're removed
+    whichever session leaves last, including ones added by sessions which
+    joined with other files.
+    """
+    def __init__(self,
+                 chroot_dir: str,
+                 paths: Sequence[str],
+                 manifest: InstallManifest) -> None:
+        self.chroot_dir = chroot_dir
+        self.paths = list(dict.fromkeys(os.path.abspath(path)
+                                        for path in paths))
+        self.manifest = manifest
+
+    def target_path(self, path: str) -> str:
+        return os.path.join(self.chroot_dir, path.lstrip("/"))
+
+    def _write_commands(self, path: str) -> List[List[str]]:
+        target_path = self.target_path(path)
+        mode = format(stat.S_IMODE(os.stat(path).st_mode), "04o")
+        return [
+            ["install", "-D", f"--mode={mode}", "--owner=root",
+             "--group=root", path, target_path + NEW_SUFFIX],
+            ["mv", "-f", "-T", target_path + NEW_SUFFIX, target_path],
+        ]
+
+    def is_up_to_date(self, path: str) -> bool:
+        try:
+            return file_digest(self.target_path(path)) == file_digest(path)
+        except (FileNotFoundError, PermissionError):
+            return False
+
+    def install_commands(self,
+                         paths: Optional[Sequence[str]] = None
+                         ) -> List[List[str]]:
+        """Makes commands putting `paths`, by default all, into chroot and
+        records them as installed, even before the commands are run, so
+        they're removed if the commands fail halfway.
+        """
+        if paths is None:
+            paths = self.paths
+        installed = self.manifest.load()
+        self.manifest.save(installed | set(paths))
+
+        commands = []
+        for path in paths:
+            target_path = self.target_path(path)
+            backup_path = target_path + BACKUP_SUFFIX
+            # Backup left by a session which was killed is the original.
+            # Without backup, recorded file is the copy it put there.
+            if (os.path.lexists(target_path)
+                    and not os.path.lexists(backup_path)
+                    and path not in installed):
+                commands.append(["mv", "-T", target_path, backup_path])
+            commands.extend(self._write_commands(path))
+        return commands
+
+    def remove_commands(self) -> List[List[str]]:
+        """Makes commands putting back chroot originals of all files
+        installed. Files with no original are removed only if they still
+        match host ones.
+        """
+        commands = []
+        for path in sorted(self.manifest.load() | set(self.paths)):
+            target_path = self.target_path(path)
+            backup_path = target_path + BACKUP_SUFFIX
+            if os.path.lexists(backup_path):
+                commands.append(["mv", "-f", "-T", backup_path, target_path])
+            elif self.is_up_to_date(path):
+                commands.append(["rm", "-f", target_path])
+        return commands
+
+    def forget(self) -> None:
+        """Clears record of installed files, once they're removed.
+        """
+        self.manifest.save(())
+
+    def remove(self) -> None:
+        commands = self.remove_commands()
+        if commands:
+            sudo_script(commands)
+        self.forget()
+
+    def put_missing(self) -> List[str]:
+        """Writes files which chroot doesn't have into it for good, without
+        recording them, so sessions take them for chroot originals.
+
+        :return: Files written.
+        """
+        missing = [path
+                   for path in self.paths
+                   if not os.path.lexists(self.target_path(path))]
+        if missing:
+            sudo_script(command
+                        for path in missing
+                        for command in self._write_commands(path))
+        return missing
+
+    def missing(self) -> List[str]:
+        """:return: Files which aren't installed yet, e.g. ones sessions
+            already in weren't given.
+        """
+        installed = self.manifest.load()
+        return [path for path in self.paths if path not in installed]
+
+    def refresh(self) -> None:
+        """Rewrites files which changed on host since they were put into
+        chroot, with a single sudo. Files are compared by hash in process.
+        """
+        outdated = [path
+                    for path in self.paths
+                    if not self.is_up_to_date(path)]
+        if outdated:
+            logging.info("Refreshing in chroot: %s", ", ".join(outdated))
+            sudo_script(command
+                        for path in outdated
+                        for command in self._write_commands(path))
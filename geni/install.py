@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import os.path
+import stat
+import subprocess
+import tarfile
+import time
+from typing import (IO,
+                    Iterable,
+                    List,
+                    NamedTuple,
+                    Optional,
+                    Set,
+                    cast)
+
+from plumbum import ProcessExecutionError
+from plumbum.cmd import (sudo,  # pylint: disable=import-error
+                         tar)
+
+from .util import file_digest, sudo_remove
+
+# Mode of parent directories created on the way, as with `install -D`.
+DIR_MODE = 0o755
+
+PROGRESS_INTERVAL = 2.0
+
+
+class InstallEntry(NamedTuple):
+    """File or directory to install, by path relative to target base
+    directory. Directories have no source path.
+    """
+    rel_path: str
+    source_path: Optional[str]
+    mode: int
+
+    @property
+    def is_dir(self) -> bool:
+        return self.source_path is None
+
+
+def is_up_to_date(entry: InstallEntry, target_path: str) -> bool:
+    """Tells whether target file matches entry by size, mode, ownership
+    and mtime, comparing content only if just mtime differs.
+    """
+    try:
+        target_stat = os.stat(target_path)
+    except FileNotFoundError:
+        return False
+    source_stat = os.stat(cast(str, entry.source_path))
+
+    if (not stat.S_ISREG(target_stat.st_mode)
+            or target_stat.st_size != source_stat.st_size
+            or stat.S_IMODE(target_stat.st_mode) != entry.mode
+            or target_stat.st_uid != 0
+            or target_stat.st_gid != 0):
+        return False
+    if int(target_stat.st_mtime) == int(source_stat.st_mtime):
+        return True
+    try:
+        return (file_digest(target_path)
+                == file_digest(cast(str, entry.source_path)))
+    except PermissionError:
+        return False
+
+
+class InstallManifest:
+    """Files installed from a source tree, kept to delete them once they
+    vanish from the source.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def load(self) -> Set[str]:
+        try:
+            with open(self.path, "r") as manifest_file:
+                return set(json.load(manifest_file))
+        except (FileNotFoundError, ValueError):
+            return set()
+
+    def save(self, rel_paths: Iterable[str]) -> None:
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as manifest_file:
+            json.dump(sorted(rel_paths), manifest_file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+class InstallPlan:
+    """Files to install as root:root into target directory, applied by a
+    single tar stream piped into one `sudo tar`, instead of spawning
+    `sudo install` for every file.
+
+    Missing parent directories are created with `DIR_MODE`. Existing
+    directories are left as they are, including symlinks to directories.
+    """
+    def __init__(self, source_base_dir: str, target_base_dir: str) -> None:
+        self.source_base_dir = source_base_dir
+        self.target_base_dir = target_base_dir
+        self.entries: List[InstallEntry] = []
+        self._dirs: Set[str] = set()
+
+    def _add_parent_dirs(self, rel_path: str) -> None:
+        parent = os.path.dirname(rel_path)
+        if not parent or parent in self._dirs:
+            return
+        self._add_parent_dirs(parent)
+        self._dirs.add(parent)
+        self.entries.append(InstallEntry(parent, None, DIR_MODE))
+
+    def add(self, rel_path: str, mode: Optional[int] = None) -> None:
+        """Adds file, by default with mode of the source file.
+        """
+        rel_path = os.path.normpath(rel_path.lstrip("/"))
+        source_path = os.path.join(self.source_base_dir, rel_path)
+        if mode is None:
+            mode = stat.S_IMODE(os.stat(source_path).st_mode)
+        self._add_parent_dirs(rel_path)
+        self.entries.append(InstallEntry(rel_path, source_path, mode))
+
+    def add_tree(self) -> None:
+        """Adds all files found under source base directory, following
+        symlinks to files.
+        """
+        for root, dirs, files in os.walk(self.source_base_dir):
+            dirs.sort()
+            rel_root = os.path.relpath(root, self.source_base_dir)
+            for file_name in sorted(files):
+                self.add(os.path.join(rel_root, file_name))
+
+    @property
+    def files(self) -> List[InstallEntry]:
+        return [entry for entry in self.entries if not entry.is_dir]
+
+    def target_path(self, rel_path: str) -> str:
+        return os.path.join(self.target_base_dir, rel_path)
+
+    def changed(self) -> 'InstallPlan':
+        """Makes plan of files which aren't installed yet or differ from
+        installed ones.
+        """
+        plan = InstallPlan(self.source_base_dir, self.target_base_dir)
+        for entry in self.files:
+            if not is_up_to_date(entry, self.target_path(entry.rel_path)):
+                plan.add(entry.rel_path, entry.mode)
+        return plan
+
+    def describe(self) -> List[str]:
+        """Lists what would be installed, one line per file or directory.
+        """
+        return [f"{entry.mode:04o} root:root "
+                f"{self.target_path(entry.rel_path)}"
+                f"{'/' if entry.is_dir else ''}"
+                for entry in self.entries]
+
+    def remove(self, rel_paths: Iterable[str]) -> None:
+        """Removes target files with a single sudo.
+        """
+        target_paths = [self.target_path(rel_path)
+                        for rel_path in sorted(rel_paths)]
+        if target_paths:
+            sudo_remove(target_paths)
+            logging.info("Removed %d files from %s",
+                         len(target_paths),
+                         self.target_base_dir)
+
+    def _make_tar_info(self, entry: InstallEntry) -> tarfile.TarInfo:
+        tar_info = tarfile.TarInfo(entry.rel_path)
+        tar_info.mode = entry.mode
+        tar_info.uid = tar_info.gid = 0
+        tar_info.uname = tar_info.gname = "root"
+        if entry.is_dir:
+            tar_info.type = tarfile.DIRTYPE
+            tar_info.mtime = int(time.time())
+        else:
+            source_stat = os.stat(cast(str, entry.source_path))
+            tar_info.size = source_stat.st_size
+            tar_info.mtime = int(source_stat.st_mtime)
+        return tar_info
+
+    def write(self, fileobj: IO[bytes]) -> int:
+        """Writes the plan as uncompressed tar stream, logging progress.
+
+        :return: Total size of files.
+        """
+        total_files = len(self.files)
+        installed_files = 0
+        size = 0
+        last_report_time = time.monotonic()
+
+        with tarfile.open(fileobj=fileobj, mode="w|",
+                          format=tarfile.GNU_FORMAT) as tar_file:
+            for entry in self.entries:
+                tar_info = self._make_tar_info(entry)
+                if entry.is_dir:
+                    tar_file.addfile(tar_info)
+                    continue
+
+                logging.debug("Installing %s", entry.rel_path)
+                with open(cast(str, entry.source_path), "rb") as source:
+                    tar_file.addfile(tar_info, source)
+                installed_files += 1
+                size += tar_info.size
+
+                if time.monotonic() - last_report_time >= PROGRESS_INTERVAL:
+                    last_report_time = time.monotonic()
+                    logging.info("Installing: %d/%d files",
+                                 installed_files,
+                                 total_files)
+
+        return size
+
+    def apply(self) -> None:
+        if not self.entries:
+            return
+
+        tar_x = sudo[tar["--extract",
+                         "--file=-",
+                         f"--directory={self.target_base_dir}",
+                         "--same-owner",
+                         "--same-permissions",
+                         "--numeric-owner",
+                         "--no-overwrite-dir",
+                         "--keep-directory-symlink"]]
+        start_time = time.monotonic()
+        size = 0
+        proc = tar_x.popen(stdin=subprocess.PIPE, stdout=None, stderr=None)
+        try:
+            size = self.write(cast(IO[bytes], proc.stdin))
+        except BrokenPipeError:
+            pass  # tar exited early, its status tells why
+        finally:
+            try:
+                cast(IO[bytes], proc.stdin).close()
+            except BrokenPipeError:
+                pass
+            retcode = proc.wait()
+
+        if retcode != 0:
+            raise ProcessExecutionError(tar_x.formulate(), retcode, "", "")
+        logging.info("Installed %d files, %.1f MiB into %s in %.1f s",
+                     len(self.files),
+                     size / 2**20,
+                     self.target_base_dir,
+                     time.monotonic() - start_time)
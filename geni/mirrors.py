@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os.path
+import time
+from typing import List, NamedTuple, Optional, Sequence
+
+from plumbum import local
+import requests
+
+from .util import join_url
+
+
+def default_mirrors_file() -> str:
+    config_home = local.env.get("XDG_CONFIG_HOME",
+                                os.path.expanduser("~/.config"))
+    return local.env.get("GENI_MIRRORS_FILE",
+                         os.path.join(config_home, "geni", "mirrors"))
+
+
+def read_mirrors_file(path: str) -> List[str]:
+    """Reads mirror URLs, one per line. Empty lines and comments starting
+    with '#' are skipped.
+    """
+    with open(path, "r") as mirrors_file:
+        return [line.strip()
+                for line in mirrors_file
+                if line.strip() and not line.strip().startswith("#")]
+
+
+def load_mirrors(mirror_urls: Sequence[str],
+                 mirrors_file: Optional[str],
+                 default_mirror: str) -> List[str]:
+    """Picks mirrors given explicitly, then from mirrors file if it exists,
+    falling back to the default one.
+    """
+    if mirror_urls:
+        return list(mirror_urls)
+    if mirrors_file and os.path.exists(mirrors_file):
+        mirrors = read_mirrors_file(mirrors_file)
+        if mirrors:
+            return mirrors
+    return [default_mirror]
+
+
+class MirrorProbe(NamedTuple):
+    url: str
+    latency: Optional[float]
+
+
+def probe_mirror(session: requests.Session,
+                 url: str,
+                 probe_path: str,
+                 timeout: float) -> MirrorProbe:
+    start_time = time.monotonic()
+    try:
+        response = session.head(join_url(url, probe_path),
+                                allow_redirects=True,
+                                timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as error:
+        logging.debug("Mirror %s is unavailable: %s", url, error)
+        return MirrorProbe(url, None)
+    return MirrorProbe(url, time.monotonic() - start_time)
+
+
+def rank_mirrors(session: requests.Session,
+                 mirror_urls: Sequence[str],
+                 probe_path: str,
+                 timeout: float = 5.0) -> List[str]:
+    """Orders mirrors by latency of concurrent HEAD requests for
+    `probe_path`.
+
+    Unavailable mirrors are moved to the end rather than dropped, so they
+    are still tried if all the others fail.
+    """
+    with ThreadPoolExecutor(max_workers=len(mirror_urls)) as pool:
+        probes = list(pool.map(lambda url: probe_mirror(session,
+                                                        url,
+                                                        probe_path,
+                                                        timeout),
+                               mirror_urls))
+
+    for probe in probes:
+        if probe.latency is None:
+            logging.info("Mirror unavailable: %s", probe.url)
+        else:
+            logging.info("Mirror latency %4.0f ms: %s",
+                         probe.latency * 1000, probe.url)
+
+    ranked = sorted(probes,
+                    key=lambda probe: (probe.latency is None,
+                                       probe.latency or 0.0))
+    return [probe.url for probe in ranked]
@@ -1,11 +1,67 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
 import os.path
-from typing import List, Optional, Type
+import re
+from typing import (Collection,
+                    Dict,
+                    Iterator,
+                    List,
+                    Optional,
+                    Sequence,
+                    Type)
 
-from plumbum.cmd import (mount,  # pylint: disable=import-error
-                         sudo,
-                         umount)
+from plumbum import ProcessExecutionError
 
-from .util import sibling_path
+from .util import (current_process_id,
+                   is_process_alive,
+                   sibling_path,
+                   sudo_script)
+
+
+def _unescape_mountinfo(field: str) -> str:
+    return re.sub(r"\\([0-7]{3})",
+                  lambda match: chr(int(match.group(1), 8)),
+                  field)
+
+
+def read_mount_points(mountinfo_path: str = "/proc/self/mountinfo"
+                      ) -> List[str]:
+    with open(mountinfo_path, "r") as mountinfo_file:
+        return [_unescape_mountinfo(line.split()[4])
+                for line in mountinfo_file
+                if line.strip()]
+
+
+def read_overlay_lower_dirs(mountinfo_path: str = "/proc/self/mountinfo"
+                            ) -> List[str]:
+    """Lists lower directories of overlays mounted, taken from their super
+    options following the " - " separator.
+    """
+    lower_dirs: List[str] = []
+    with open(mountinfo_path, "r") as mountinfo_file:
+        for line in mountinfo_file:
+            _, separator, fs_fields = line.partition(" - ")
+            fs_fields_list = fs_fields.split()
+            if (not separator or len(fs_fields_list) < 3
+                    or fs_fields_list[0] != "overlay"):
+                continue
+            for option in fs_fields_list[2].split(","):
+                if option.startswith("lowerdir="):
+                    lower_dirs.extend(
+                        _unescape_mountinfo(lower_dir)
+                        for lower_dir in option[len("lowerdir="):].split(":"))
+    return lower_dirs
+
+
+def mounts_under(path: str) -> List[str]:
+    """Lists mount points below `path`, excluding `path` itself.
+    """
+    prefix = os.path.realpath(path).rstrip("/") + "/"
+    return [mount_point
+            for mount_point in read_mount_points()
+            if mount_point.startswith(prefix) and mount_point != prefix]
 
 
 class Mount:
@@ -13,11 +69,13 @@ class Mount:
                  device: str,
                  mount_point: str,
                  *opts: str,
-                 make_rslave: bool = False) -> None:
+                 make_rslave: bool = False,
+                 create_mount_point: bool = False) -> None:
         self.device = device
         self.mount_point = mount_point
         self.opts = opts
         self.make_rslave = make_rslave
+        self.create_mount_point = create_mount_point
 
     def __enter__(self) -> str:
         self.mount()
@@ -30,30 +88,58 @@ class Mount:
         self.umount()
         return False
 
-    def mount(self) -> None:
-        sudo[mount[self.opts, self.device, self.mount_point]]()
-
+    def mount_commands(self) -> List[List[str]]:
+        commands = [["mount", *self.opts, self.device, self.mount_point]]
+        if self.create_mount_point:
+            commands.insert(0, ["mkdir", "-p", self.mount_point])
         if self.make_rslave:
-            sudo[mount["--make-rslave", self.mount_point]]()
+            commands.append(["mount", "--make-rslave", self.mount_point])
+        return commands
 
-    def umount(self) -> None:
+    def umount_commands(self, lazy: bool = False) -> List[List[str]]:
         opts = []
         if self.make_rslave:
             opts.append("-R")
-        sudo[umount[opts, self.mount_point]]()
+        if lazy:
+            opts.append("--lazy")
+        return [["umount", *opts, self.mount_point]]
+
+    def is_mounted(self,
+                   mount_points: Optional[Collection[str]] = None) -> bool:
+        if mount_points is None:
+            mount_points = read_mount_points()
+        return os.path.realpath(self.mount_point) in mount_points
+
+    def mount(self) -> None:
+        sudo_script(self.mount_commands())
+
+    def umount(self, lazy: bool = False) -> None:
+        sudo_script(self.umount_commands(lazy))
 
 
 class BindMount(Mount):
     def __init__(self,
                  source_dir: str,
                  mount_point: str,
-                 *opts: str) -> None:
+                 *opts: str,
+                 create_mount_point: bool = False,
+                 read_only: bool = False) -> None:
         super().__init__(
             source_dir,
             mount_point,
             "--bind",
             *opts,
-            make_rslave=False)
+            make_rslave=False,
+            create_mount_point=create_mount_point)
+        self.read_only = read_only
+
+    def mount_commands(self) -> List[List[str]]:
+        commands = super().mount_commands()
+        if self.read_only:
+            # Bind mount ignores "ro" until it's remounted.
+            commands.append(["mount", "-o", "remount,bind,ro",
+                             self.mount_point])
+        return commands
 
 
 class OverlayMount(Mount):
@@ -80,9 +166,107 @@ class OverlayMount(Mount):
             make_rslave=False)
 
 
+class MountJournal:
+    """Mounts made by geni processes along with their owners, persisted so
+    that mounts left behind by killed processes can be cleaned up.
+
+    Mounts are either shared by all sessions, to be unmounted by the last
+    one out whoever made them, or owned by a session which unmounts them by
+    itself.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @contextmanager
+    def _locked(self) -> Iterator[List[Dict]]:
+        with open(self.path, "a+") as journal_file:
+            fcntl.flock(journal_file, fcntl.LOCK_EX)
+            journal_file.seek(0)
+            try:
+                entries = json.loads(journal_file.read() or "[]")
+            except ValueError:
+                entries = []
+
+            yield entries
+
+            journal_file.truncate(0)
+            json.dump(entries, journal_file, indent=2)
+            journal_file.flush()
+
+    def record(self, *mounts: Mount, shared: bool = False) -> None:
+        owner = current_process_id()
+        with self._locked() as entries:
+            entries.extend({
+                "device": mount_.device,
+                "mount_point": mount_.mount_point,
+                "recursive": mount_.make_rslave,
+                "owner": owner,
+                "shared": shared,
+            } for mount_ in mounts)
+
+    def forget(self, *mounts: Mount) -> None:
+        with self._locked() as entries:
+            for mount_ in mounts:
+                for entry in reversed(entries):
+                    if entry["mount_point"] == mount_.mount_point:
+                        entries.remove(entry)
+                        break
+
+    def mounts(self, shared_only: bool = False) -> List[Mount]:
+        """:return: Recorded mounts of all owners, in order they were made.
+        """
+        with self._locked() as entries:
+            return [Mount(entry["device"],
+                          entry["mount_point"],
+                          make_rslave=entry["recursive"])
+                    for entry in entries
+                    if entry.get("shared", False) or not shared_only]
+
+    def recover(self) -> List[str]:
+        """Unmounts what's left by owners which are no longer running,
+        deepest mount points first, and drops them from the journal.
+
+        Mounts failing to unmount are kept in the journal to be retried.
+
+        :return: Unmounted mount points.
+        """
+        mount_points = set(read_mount_points())
+        recovered = []
+
+        with self._locked() as entries:
+            orphans = sorted(
+                (entry
+                 for entry in reversed(entries)
+                 if not is_process_alive(entry["owner"])),
+                key=lambda entry: entry["mount_point"].count("/"),
+                reverse=True)
+
+            for entry in orphans:
+                mount_point = entry["mount_point"]
+                if os.path.realpath(mount_point) in mount_points:
+                    logging.info("Unmounting stale mount: %s", mount_point)
+                    try:
+                        Mount(entry["device"],
+                              mount_point,
+                              make_rslave=entry["recursive"]).umount()
+                    except ProcessExecutionError as error:
+                        logging.error("Failed to unmount %s: %s",
+                                      mount_point, error)
+                        continue
+                    recovered.append(mount_point)
+                entries.remove(entry)
+
+        return recovered
+
+
 class MountsManager:
-    def __init__(self, base_dir: str) -> None:
+    def __init__(self,
+                 base_dir: str,
+                 journal: Optional[MountJournal] = None,
+                 shared: bool = False) -> None:
         self.base_dir = base_dir
+        self.journal = journal
+        self.shared = shared
         self.mounts: List[Mount] = []
 
     def __enter__(self) -> 'MountsManager':
@@ -95,19 +279,112 @@ class MountsManager:
         self.umount_all()
         return False
 
+    def _track(self, mounts: Sequence[Mount]) -> None:
+        self.mounts.extend(mounts)
+        if self.journal is not None and mounts:
+            self.journal.record(*mounts, shared=self.shared)
+
+    def _untrack(self, mounts: Sequence[Mount]) -> None:
+        for mount_ in mounts:
+            self.mounts.remove(mount_)
+        if self.journal is not None and mounts:
+            self.journal.forget(*mounts)
+
     def add(self, mount_: Mount) -> None:
+        self.add_all([mount_])
+
+    def add_all(self,
+                mounts: Sequence[Mount],
+                extra_commands: Sequence[Sequence[str]] = ()) -> None:
+        """Mounts all in order with a single sudo, stopping at the first
+        failure. `extra_commands` are run as root first, in the same script.
+        """
+        if not mounts and not extra_commands:
+            return
+
+        try:
+            sudo_script([
+                *extra_commands,
+                *(command
+                  for mount_ in mounts
+                  for command in mount_.mount_commands()),
+            ])
+        except ProcessExecutionError:
+            mount_points = read_mount_points()
+            self._track([mount_
+                         for mount_ in mounts
+                         if mount_.is_mounted(mount_points)])
+            raise
+        self._track(mounts)
+
+    def adopt(self, mount_: Mount) -> None:
+        """Takes over mount made by someone else, so it's unmounted with
+        the others.
+        """
         self.mounts.append(mount_)
-        mount_.mount()
+
+    def adopt_recorded(self) -> None:
+        """Takes over shared mounts recorded in journal which are still
+        mounted, whoever made them, so they're unmounted in reverse order they
+        were made. Mounts recorded but not mounted and mounts owned by
+        sessions are left out.
+        """
+        if self.journal is None:
+            return
+        mount_points = read_mount_points()
+        recorded: Dict[str, Mount] = {}
+        for mount_ in self.journal.mounts(shared_only=True):
+            recorded.pop(mount_.mount_point, None)
+            recorded[mount_.mount_point] = mount_
+        self.mounts = [mount_
+                       for mount_ in recorded.values()
+                       if mount_.is_mounted(mount_points)]
+
+    def make_mount(self,
+                   device: str,
+                   directory: str,
+                   *opts: str,
+                   make_rslave: bool = False,
+                   create_mount_point: bool = False) -> Mount:
+        mount_point = os.path.join(self.base_dir, directory.lstrip("/"))
+        return Mount(device,
+                     mount_point,
+                     *opts,
+                     make_rslave=make_rslave,
+                     create_mount_point=create_mount_point)
 
     def mount(self,
               device: str,
               directory: str,
               *opts: str,
               make_rslave: bool = False) -> None:
-        mount_point = os.path.join(self.base_dir, directory.lstrip("/"))
-        mount_ = Mount(device, mount_point, *opts, make_rslave=make_rslave)
-        self.add(mount_)
+        self.add(self.make_mount(device,
+                                 directory,
+                                 *opts,
+                                 make_rslave=make_rslave))
+
+    def umount_all(self,
+                   lazy: bool = False,
+                   extra_commands: Sequence[Sequence[str]] = ()):
+        """Unmounts all in reverse order with a single sudo, stopping at the
+        first failure. `extra_commands` are run as root last, in the same
+        script.
+        """
+        if not self.mounts and not extra_commands:
+            return
 
-    def umount_all(self):
-        while self.mounts:
-            self.mounts.pop().umount()
+        mounts = list(reversed(self.mounts))
+        try:
+            sudo_script([
+                *(command
+                  for mount_ in mounts
+                  for command in mount_.umount_commands(lazy)),
+                *extra_commands,
+            ])
+        except ProcessExecutionError:
+            mount_points = read_mount_points()
+            self._untrack([mount_
+                           for mount_ in mounts
+                           if not mount_.is_mounted(mount_points)])
+            raise
+        self._untrack(mounts)
@@ -0,0 +1,98 @@
+import os
+import re
+from typing import List, NamedTuple, Optional
+
+# Memory a single compiler job may take, e.g. C++ with optimisations.
+RAM_PER_JOB = 2 * 2**30
+
+# Packages emerged at once, each running its own make jobs.
+MAX_EMERGE_JOBS = 4
+
+
+class Parallelism(NamedTuple):
+    make_jobs: int
+    emerge_jobs: int
+    load_average: float
+
+    @property
+    def makeopts(self) -> str:
+        return f"-j{self.make_jobs} -l{self.load_average:g}"
+
+    @property
+    def emerge_opts(self) -> List[str]:
+        return ["--jobs", str(self.emerge_jobs),
+                "--load-average", f"{self.load_average:g}"]
+
+
+def available_cpus() -> int:
+    """Counts CPUs this process may run on, which may be fewer than there
+    are, e.g. in a container.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def read_mem_available(meminfo_path: str = "/proc/meminfo") -> int:
+    """:return: Memory available for new processes in bytes.
+    """
+    with open(meminfo_path, "r") as meminfo_file:
+        match = re.search(r"^MemAvailable:\s+(\d+) kB",
+                          meminfo_file.read(),
+                          re.MULTILINE)
+    if match is None:
+        raise ValueError(f"No MemAvailable in {meminfo_path}")
+    return int(match.group(1)) * 1024
+
+
+def compute_parallelism(cpus: Optional[int] = None,
+                        mem_available: Optional[int] = None,
+                        ram_per_job: int = RAM_PER_JOB,
+                        tmpfs_size: int = 0) -> Parallelism:
+    """Computes build parallelism so that compiler jobs of all packages
+    emerged at once fit in memory left after `tmpfs_size` is taken, e.g. by
+    tmpfs holding build directories.
+
+    Make jobs are capped by CPUs. Packages emerged at once aren't, as much
+    of their builds is single threaded, but both make and emerge back off
+    once load average reaches the number of CPUs.
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    if mem_available is None:
+        mem_available = read_mem_available()
+
+    mem_jobs = max(1, (mem_available - tmpfs_size) // ram_per_job)
+    make_jobs = max(1, min(cpus, mem_jobs))
+    emerge_jobs = max(1, min(MAX_EMERGE_JOBS, mem_jobs // make_jobs))
+    return Parallelism(make_jobs, emerge_jobs, float(cpus))
+
+
+def set_make_conf_parallelism(make_conf: str,
+                              parallelism: Parallelism) -> str:
+    """Sets MAKEOPTS and adds emerge jobs to EMERGE_DEFAULT_OPTS of
+    make.conf content, replacing previous values.
+    """
+    makeopts_line = f'MAKEOPTS="{parallelism.makeopts}"'
+    make_conf, found = re.subn(r"^#?MAKEOPTS=.*$",
+                               makeopts_line,
+                               make_conf,
+                               count=1,
+                               flags=re.MULTILINE)
+    if not found:
+        make_conf += f"\n{makeopts_line}\n"
+
+    def set_emerge_opts(match) -> str:
+        opts = re.sub(r"\s*--(jobs|load-average)[= ]\S+", "", match.group(1))
+        return ('EMERGE_DEFAULT_OPTS="'
+                f'{" ".join([opts, *parallelism.emerge_opts]).strip()}"')
+
+    make_conf, found = re.subn(r'^EMERGE_DEFAULT_OPTS="(.*)"$',
+                               set_emerge_opts,
+                               make_conf,
+                               count=1,
+                               flags=re.MULTILINE)
+    if not found:
+        make_conf += ('EMERGE_DEFAULT_OPTS='
+                      f'"{" ".join(parallelism.emerge_opts)}"\n')
+    return make_conf
@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+import fcntl
+import logging
+import os
+import os.path
+from typing import IO, Iterator, List, NamedTuple
+
+from plumbum.cmd import (find,  # pylint: disable=import-error
+                         sudo)
+
+from .mount import BindMount
+from .util import sibling_path, sudo_remove
+
+DISTDIR = "/usr/portage/distfiles"
+PKGDIR = "/usr/portage/packages"
+
+# Binary packages index, which portage reconciles with packages present.
+_KEEP_FILES = {"Packages"}
+
+
+class _CachedFile(NamedTuple):
+    path: str
+    size: int
+    last_used: float
+
+
+class SharedCache:
+    """Host directory shared by chroots, bind mounted over `chroot_path`,
+    e.g. DISTDIR or PKGDIR.
+
+    Portage locks files it writes there by itself. Chroot sessions hold a
+    shared lock on the cache while they're in, and cleaning or pruning it
+    takes the lock exclusively, so it doesn't happen under a running build.
+    The lock file is next to the directory, as portage may take the
+    directory over.
+    """
+    def __init__(self, path: str, chroot_path: str) -> None:
+        self.path = os.path.abspath(path)
+        self.chroot_path = chroot_path
+        self.lock_path = sibling_path(self.path, ".{}.geni-lock".format)
+        os.makedirs(self.path, exist_ok=True)
+
+    def make_mount(self, chroot_dir: str) -> BindMount:
+        mount_point = os.path.join(chroot_dir, self.chroot_path.lstrip("/"))
+        return BindMount(self.path, mount_point, create_mount_point=True)
+
+    def _lock(self, operation: int) -> IO:
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info("Waiting for %s to be released", self.path)
+            try:
+                fcntl.flock(lock_file, operation)
+            except:  # noqa: E722
+                lock_file.close()
+                raise
+        return lock_file
+
+    def hold(self) -> IO:
+        """Locks cache for use until returned file is closed.
+        """
+        return self._lock(fcntl.LOCK_SH)
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._lock(fcntl.LOCK_EX):
+            yield
+
+    def _files(self) -> List[_CachedFile]:
+        files = []
+        for root, _dirs, file_names in os.walk(self.path):
+            for file_name in file_names:
+                if (file_name in _KEEP_FILES
+                        or os.path.basename(root) == ".locks"):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    file_stat = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                files.append(_CachedFile(path,
+                                         file_stat.st_size,
+                                         max(file_stat.st_atime,
+                                             file_stat.st_mtime)))
+        return files
+
+    def clean(self) -> None:
+        """Removes all content, once no chroot uses the cache.
+        """
+        with self.exclusive():
+            sudo[find[self.path, "-mindepth", "1", "-delete"]]()
+
+    def prune(self, max_size: int) -> List[str]:
+        """Removes least recently used files until the cache takes at most
+        `max_size` bytes, once no chroot uses it.
+
+        :return: Removed files.
+        """
+        with self.exclusive():
+            files = sorted(self._files(),
+                           key=lambda file_: file_.last_used,
+                           reverse=True)
+            total_size = 0
+            removed = []
+            for file_ in files:
+                total_size += file_.size
+                if total_size > max_size:
+                    removed.append(file_.path)
+            sudo_remove(removed)
+
+        logging.info("Removed %d files from %s", len(removed), self.path)
+        return removed
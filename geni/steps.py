@@ -0,0 +1,115 @@
+from concurrent.futures import (FIRST_COMPLETED,
+                                Future,
+                                ThreadPoolExecutor,
+                                wait)
+import logging
+import os.path
+import time
+from typing import (AbstractSet,
+                    Any,
+                    Callable,
+                    Dict,
+                    List,
+                    NamedTuple,
+                    Optional,
+                    Sequence,
+                    Set)
+
+
+class Step(NamedTuple):
+    """Action along with paths it reads and writes, e.g. in chroot.
+
+    A path covers everything below it.
+    """
+    name: str
+    func: Callable[[], Any]
+    reads: AbstractSet[str] = frozenset()
+    writes: AbstractSet[str] = frozenset()
+
+
+class StepTiming(NamedTuple):
+    name: str
+    elapsed: float
+
+
+def _overlap(path: str, other_path: str) -> bool:
+    path = os.path.normpath(path)
+    other_path = os.path.normpath(other_path)
+    return (path == other_path
+            or other_path.startswith(path.rstrip("/") + "/")
+            or path.startswith(other_path.rstrip("/") + "/"))
+
+
+def _any_overlap(paths: AbstractSet[str],
+                 other_paths: AbstractSet[str]) -> bool:
+    return any(_overlap(path, other_path)
+               for path in paths
+               for other_path in other_paths)
+
+
+def conflict(step: Step, other_step: Step) -> bool:
+    return (_any_overlap(step.writes, other_step.reads | other_step.writes)
+            or _any_overlap(step.reads, other_step.writes))
+
+
+def log_timings(timings: Sequence[StepTiming], elapsed: float) -> None:
+    for timing in timings:
+        logging.info("  %-24s %7.2f s", timing.name, timing.elapsed)
+    logging.info("  %-24s %7.2f s", "total (wall clock)", elapsed)
+
+
+def run_steps(steps: Sequence[Step],
+              max_workers: Optional[int] = None) -> List[StepTiming]:
+    """Runs steps concurrently, except that each step waits for the earlier
+    ones it conflicts with.
+
+    After a step fails, no more steps are started. Once running steps
+    finish, exception of the first failed one is raised.
+
+    :return: Timings of steps in order of completion.
+    """
+    waits_for: Dict[int, Set[int]] = {
+        index: {earlier
+                for earlier in range(index)
+                if conflict(steps[earlier], step)}
+        for index, step in enumerate(steps)
+    }
+    pending = list(range(len(steps)))
+    running: Dict[Future, int] = {}
+    done: Set[int] = set()
+    timings: List[StepTiming] = []
+    error: Optional[BaseException] = None
+    start_time = time.monotonic()
+
+    def timed(step: Step) -> float:
+        step_start_time = time.monotonic()
+        logging.debug("Starting step: %s", step.name)
+        step.func()
+        return time.monotonic() - step_start_time
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for index in list(pending):
+                if error is None and waits_for[index] <= done:
+                    pending.remove(index)
+                    running[pool.submit(timed, steps[index])] = index
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                if future.exception() is not None:
+                    logging.error("Step failed: %s", steps[index].name)
+                    error = error or future.exception()
+                else:
+                    done.add(index)
+                    timings.append(StepTiming(steps[index].name,
+                                              future.result()))
+
+    if steps:
+        logging.info("Step timings:")
+        log_timings(timings, time.monotonic() - start_time)
+    if error is not None:
+        raise error
+    return timings
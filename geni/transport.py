@@ -0,0 +1,64 @@
+import logging
+from typing import Dict, NamedTuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .util import make_proxies_dict
+
+
+class TransportConfig(NamedTuple):
+    pool_size: int = 10
+    connect_timeout: float = 10.0
+    read_timeout: float = 30.0
+    retries: int = 3
+    backoff_factor: float = 0.5
+
+
+def make_requests_proxies() -> Dict[str, str]:
+    """Translates proxies from environment as passed to chroot into
+    requests' format.
+    """
+    return {var[:-len("_proxy")]: url
+            for var, url in make_proxies_dict().items()}
+
+
+def log_timing(response: requests.Response, *_args, **_kwargs) -> None:
+    logging.debug("%s %s: %d in %.0f ms",
+                  response.request.method,
+                  response.url,
+                  response.status_code,
+                  response.elapsed.total_seconds() * 1000)
+
+
+class Session(requests.Session):
+    """Session with pooled keep-alive connections, default timeouts and
+    retries with exponential backoff.
+
+    The read timeout also bounds how long a streamed download may stall.
+    """
+    def __init__(self, config: TransportConfig = TransportConfig()) -> None:
+        super().__init__()
+        self.config = config
+
+        retry = Retry(total=config.retries,
+                      backoff_factor=config.backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=config.pool_size,
+                              pool_maxsize=config.pool_size,
+                              max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self.proxies.update(make_requests_proxies())
+        self.hooks["response"].append(log_timing)
+
+    def request(self,  # pylint: disable=arguments-differ
+                method,
+                url,
+                *args,
+                **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", (self.config.connect_timeout,
+                                      self.config.read_timeout))
+        return super().request(method, url, *args, **kwargs)
@@ -1,19 +1,27 @@
 from contextlib import contextmanager
+import fcntl
 import hashlib
 import os
 import os.path
-from typing import Any, Callable, Dict, List, Optional, Tuple
+import shlex
+import signal
+import threading
+from typing import (IO,
+                    Any,
+                    Callable,
+                    Dict,
+                    Iterable,
+                    Iterator,
+                    List,
+                    Optional,
+                    Sequence,
+                    Tuple)
 
 from plumbum import local
-from plumbum.cmd import (cp,  # pylint: disable=import-error
-                         diff,
-                         echo,
-                         install,
-                         rm,
+from plumbum.cmd import (echo,  # pylint: disable=import-error
                          sudo,
                          tee)
 from plumbum.machines import LocalCommand
-import portalocker
 
 
 class ExceptionEater:
@@ -35,125 +43,151 @@ class ExceptionEater:
             raise self.exceptions[0]
 
 
-class FileInstaller:
-    def __init__(self, source_base_dir: str, target_base_dir: str) -> None:
-        self.source_base_dir = source_base_dir
-        self.target_base_dir = target_base_dir
-        self.files: List[str] = []
-
-    def _make_source_path(self, rel_path: str) -> str:
-        return os.path.join(self.source_base_dir, rel_path.lstrip("/"))
-
-    def _make_target_path(self, rel_path: str) -> str:
-        return os.path.join(self.target_base_dir, rel_path.lstrip("/"))
-
-    def _remove(self, rel_path: str) -> None:
-        sudo[rm[self._make_target_path(rel_path)]]()
-
-    def ensure_is_copied(self, rel_path: str) -> None:
-        source_path = self._make_source_path(rel_path)
-        target_path = self._make_target_path(rel_path)
-        diff[source_path, target_path]()
-
-    def copy(self, rel_path: str) -> str:
-        source_path = self._make_source_path(rel_path)
-        target_path = self._make_target_path(rel_path)
-        sudo[cp["--dereference", source_path, target_path]]()
-        self.files.append(rel_path)
-        return target_path
-
-    def install(self, rel_path: str, mode: Optional[str] = None) -> str:
-        source_path = self._make_source_path(rel_path)
-        target_path = self._make_target_path(rel_path)
-        if mode is None:
-            mode = format(os.stat(source_path).st_mode & 0o7777, "04o")
-        sudo[install[f"--mode={mode}",
-                     "--owner=root",
-                     "--group=root",
-                     "-D",
-                     source_path,
-                     target_path]]()
-        self.files.append(rel_path)
-        return target_path
-
-    def uninstall(self, rel_path: str) -> None:
-        self._remove(rel_path)
-        self.files.remove(rel_path)
-
-    def uninstall_all(self) -> None:
-        while self.files:
-            rel_path = self.files.pop()
-            self._remove(rel_path)
+class FileSemaphore:
+    """Counter of sessions shared between processes.
 
+    Sessions are recorded in a single file, each as PID and start time of
+    the process holding it, so sessions of processes which died without
+    leaving are dropped. The file is locked in place and never removed.
 
-class FileSemaphore:
+    Callbacks passed to `up` and `down` are run while the file is still
+    locked, so other sessions block until the first one in has finished
+    setting up, or the last one out has finished tearing down.
+    """
     def __init__(self, path: str) -> None:
         self.sem_file_path = path
-        self.lock_file_path = path + ".lock"
 
-    def _read(self) -> int:
-        try:
-            with portalocker.Lock(self.lock_file_path) as lock_file:
-                if os.path.exists(self.sem_file_path):
-                    with portalocker.Lock(self.sem_file_path,
-                                          mode="r") as lock_file:
-                        return int(lock_file.read().strip() or 0)
-                else:
-                    return 0
-        finally:
-            os.remove(self.lock_file_path)
-
-    def _update(self, func: Callable[[int], int]) -> int:
-        counter = -1
+    @contextmanager
+    def _locked(self, operation: int) -> Iterator[List[str]]:
+        """Yields live sessions, to be modified in place if the lock is
+        exclusive. Modified sessions are stored even if an exception is
+        raised.
+        """
+        with open(self.sem_file_path, "a+") as sem_file:
+            # Blocking lock, as callbacks may take longer than any sane
+            # timeout, e.g. if sudo asks for password.
+            fcntl.flock(sem_file, operation)
+            sem_file.seek(0)
+            sessions = [session
+                        for session in sem_file.read().split()
+                        if is_process_alive(session)]
+
+            try:
+                yield sessions
+            finally:
+                if operation == fcntl.LOCK_EX:
+                    sem_file.truncate(0)
+                    sem_file.write("".join(f"{session}\n"
+                                           for session in sessions))
+                    sem_file.flush()
+
+    def down(self, on_last: Optional[Callable[[], None]] = None) -> int:
+        """Drops session of this process and calls `on_last` if it was the
+        last one. The session is dropped even if `on_last` fails.
+        """
+        with self._locked(fcntl.LOCK_EX) as sessions:
+            session = current_process_id()
+            if session in sessions:
+                sessions.remove(session)
+            if not sessions and on_last is not None:
+                on_last()
+            return len(sessions)
 
-        try:
-            with portalocker.Lock(self.lock_file_path) as lock_file:
-                if os.path.exists(self.sem_file_path):
-                    with portalocker.Lock(self.sem_file_path,
-                                          mode="r") as lock_file:
-                        counter = int(lock_file.read().strip() or 0)
-                else:
-                    counter = 0
-
-                counter = func(counter)
-
-                with portalocker.Lock(self.sem_file_path,
-                                      mode="w") as lock_file:
-                    lock_file.write(str(counter))
+    def get(self) -> int:
+        with self._locked(fcntl.LOCK_SH) as sessions:
+            return len(sessions)
+
+    def run_if_idle(self, func: Callable[[], None]) -> bool:
+        """Calls `func` unless there are any live sessions, keeping new
+        sessions out until it's done.
+
+        :return: Whether `func` was called.
+        """
+        with self._locked(fcntl.LOCK_EX) as sessions:
+            if sessions:
+                return False
+            func()
+            return True
+
+    def run_exclusive(self, func: Callable[[], None]) -> None:
+        """Calls `func` keeping sessions from joining or leaving until it's
+        done.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            func()
+
+    def up(self,  # pylint: disable=invalid-name
+           on_first: Optional[Callable[[], None]] = None,
+           on_join: Optional[Callable[[], None]] = None) -> int:
+        """Adds session of this process, calling `on_first` before if there
+        are no other sessions, or `on_join` if there are. The session isn't
+        added if the callback fails.
+        """
+        with self._locked(fcntl.LOCK_EX) as sessions:
+            if not sessions and on_first is not None:
+                on_first()
+            elif sessions and on_join is not None:
+                on_join()
+            sessions.append(current_process_id())
+            return len(sessions)
+
+
+def current_process_id() -> str:
+    """Identifies current process by PID and start time, so it's not
+    mistaken for a later process given the same PID.
+    """
+    pid = os.getpid()
+    return f"{pid}:{process_start_time(pid)}"
 
-            return counter
-        finally:
-            os.remove(self.lock_file_path)
-            if counter == 0:
-                os.remove(self.sem_file_path)
 
-    def down(self) -> int:
-        return self._update(lambda counter: counter - 1)
+def drop_prefix(prefix: str, string: str) -> str:
+    return string[len(prefix):] if string.startswith(prefix) else string
 
-    def get(self) -> int:
-        return self._read()
 
-    def up(self) -> int:  # pylint: disable=invalid-name
-        return self._update(lambda counter: counter + 1)
+def file_digest(path: str) -> bytes:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file_:
+        for chunk in iter(lambda: file_.read(2**20), b""):
+            hasher.update(chunk)
+    return hasher.digest()
 
 
-class FileTempInst:
-    def __init__(self, chroot_dir: str, file_path: str) -> None:
-        self.inst = FileInstaller("/", chroot_dir)
-        self.file_path = file_path
+class _LockTimedOut(Exception):
+    pass
 
-    def copy(self) -> None:
-        self.inst.copy(self.file_path)
 
-    def ensure_is_copied(self) -> None:
-        self.inst.ensure_is_copied(self.file_path)
+def flock_waiting(file_: IO,
+                  operation: int,
+                  timeout: Optional[float] = None) -> bool:
+    """Blocks until `file_` is locked with `operation` (`fcntl.LOCK_SH` or
+    `fcntl.LOCK_EX`), woken up by the kernel rather than polling.
 
-    def remove(self) -> None:
-        self.inst.uninstall_all()
+    :param timeout: Seconds to wait for or None to wait indefinitely. Wait
+        is interrupted with SIGALRM, so it works in main thread only.
+    :return: False if timed out.
+    """
+    if timeout is None:
+        fcntl.flock(file_, operation)
+        return True
 
+    def on_alarm(_signum, _frame):
+        raise _LockTimedOut()
 
-def drop_prefix(prefix: str, string: str) -> str:
-    return string[len(prefix):] if string.startswith(prefix) else string
+    orig_handler = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, max(timeout, 0.001))
+    try:
+        fcntl.flock(file_, operation)
+        return True
+    except _LockTimedOut:
+        # Alarm might have gone off right after the lock was taken.
+        try:
+            fcntl.flock(file_, operation | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, orig_handler)
 
 
 def hash_path(path: str) -> str:
@@ -162,6 +196,14 @@ def hash_path(path: str) -> str:
     return hasher.hexdigest()
 
 
+def is_process_alive(process_id: str) -> bool:
+    """Tells whether process identified by `current_process_id` is still
+    running.
+    """
+    pid, _, start_time = process_id.partition(":")
+    return pid.isdigit() and process_start_time(int(pid)) == start_time
+
+
 def join_url(base_url: str, path: str) -> str:
     return "/".join((base_url.rstrip("/"), path.lstrip("/")))
 
@@ -176,14 +218,60 @@ def make_proxies_dict() -> Dict[str, str]:
     return proxies
 
 
+def make_script(commands: Iterable[Sequence[str]]) -> str:
+    return "\n".join(" ".join(map(shlex.quote, command))
+                     for command in commands)
+
+
+class _NoEscaping:
+    lock = threading.Lock()
+    depth = 0
+    orig_quote_level = LocalCommand.QUOTE_LEVEL
+
+
 @contextmanager
 def no_escaping():
-    orig_quote_level = LocalCommand.QUOTE_LEVEL
-    LocalCommand.QUOTE_LEVEL = 0xffffffff
+    """Disables escaping of nested plumbum commands' arguments.
+
+    The setting is global, so it's reference counted to be safe to use by
+    several threads at once. Escaping is restored once all of them leave.
+    """
+    with _NoEscaping.lock:
+        if _NoEscaping.depth == 0:
+            _NoEscaping.orig_quote_level = LocalCommand.QUOTE_LEVEL
+            LocalCommand.QUOTE_LEVEL = 0xffffffff
+        _NoEscaping.depth += 1
     try:
         yield
     finally:
-        LocalCommand.QUOTE_LEVEL = orig_quote_level
+        with _NoEscaping.lock:
+            _NoEscaping.depth -= 1
+            if _NoEscaping.depth == 0:
+                LocalCommand.QUOTE_LEVEL = _NoEscaping.orig_quote_level
+
+
+def parse_size(size: str) -> int:
+    """Parses size in bytes with optional binary unit suffix, e.g. "512M".
+    """
+    units = "KMGT"
+    size = size.strip().upper().rstrip("IB")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(size)
+
+
+def process_start_time(pid: int) -> Optional[str]:
+    """Start time of process in clock ticks since boot, which tells apart
+    processes given the same PID. None if there's no such process.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "r") as stat_file:
+            stat = stat_file.read()
+    except FileNotFoundError:
+        return None
+    # Process name in parentheses may contain spaces, so fields are counted
+    # from the closing one. Start time is the 22nd field.
+    return stat.rpartition(")")[2].split()[19]
 
 
 def sibling_path(path: str, rename_leaf: Callable[[str], str]) -> str:
@@ -196,5 +284,20 @@ def sudo_append(path: str, content: str) -> None:
     (echo["-n", content] | sudo[tee, "--append", path] > '/dev/null')()
 
 
+def sudo_remove(paths: Iterable[str]) -> None:
+    """Removes files as root with a single sudo, passing paths on stdin so
+    there's no limit on their number.
+    """
+    (sudo["xargs", "-0", "--no-run-if-empty", "rm", "-f", "--"]
+     << "\0".join(paths))()
+
+
+def sudo_script(commands: Iterable[Sequence[str]]) -> None:
+    """Runs commands as root with a single sudo, stopping at the first one
+    that fails.
+    """
+    sudo["sh", "-e", "-c", make_script(commands)]()
+
+
 def sudo_write(path: str, content: str) -> None:
     (echo["-n", content] | sudo[tee, path] > '/dev/null')()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Compares decompressors geni may extract stage3 tarball with, on
+a synthetic tarball compressed with every format there's a compressor for.
+
+Run from the source tree: `python scripts/bench_decompress.py --size 512M`.
+Archives are compressed multi-threaded, so they consist of blocks which
+parallel decompressors can spread over CPUs.
+"""
+import os
+import os.path
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+from plumbum import CommandNotFound, cli, local
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from geni.decompress import (DECOMPRESSORS,  # noqa: E402
+                             find_decompressor)
+from geni.exceptions import GeniException  # noqa: E402
+from geni.util import parse_size  # noqa: E402
+
+# Compressors making archives of each extension, in multi-threaded mode.
+COMPRESSORS = {
+    ".xz": ("xz", "-T0", "-6"),
+    ".zst": ("zstd", "-T0", "-19", "--long=27"),
+    ".gz": ("pigz",),
+    ".bz2": ("lbzip2",),
+}
+
+FILE_SIZE = 256 * 2**10
+
+
+def make_file_content(rand: random.Random, size: int) -> bytes:
+    """Makes content compressing roughly as binaries and text of stage3,
+    i.e. half random, half repeated words.
+    """
+    words = [b"usr", b"lib", b"share", b"gentoo", b"portage", b"include"]
+    text = b" ".join(rand.choice(words) for _ in range(size // 12))
+    return (rand.getrandbits(size // 2 * 8).to_bytes(size // 2, "little")
+            + text)[:size]
+
+
+def make_tarball(path: str, size: int) -> int:
+    """:return: Total size of files in the tarball.
+    """
+    rand = random.Random(0)
+    total = 0
+    with tarfile.open(path, "w") as tar_file:
+        for index in range(max(1, size // FILE_SIZE)):
+            content = make_file_content(rand, FILE_SIZE)
+            info = tarfile.TarInfo(f"dir{index % 64}/file{index}")
+            info.size = len(content)
+            with tempfile.TemporaryFile() as content_file:
+                content_file.write(content)
+                content_file.seek(0)
+                tar_file.addfile(info, content_file)
+            total += len(content)
+    return total
+
+
+def compress(tar_path: str, extension: str) -> Optional[str]:
+    program, *args = COMPRESSORS[extension]
+    try:
+        compressor = local[program]
+    except CommandNotFound:
+        return None
+    archive_path = tar_path + extension
+    ((compressor[args + ["-c"]] < tar_path) > archive_path)()
+    return archive_path
+
+
+def extract(archive_path: str,
+            output_dir: str,
+            compress_program: Optional[str]) -> float:
+    """:return: Seconds taken.
+    """
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    args = ["-x", "-f", archive_path, "-C", output_dir]
+    if compress_program:
+        args.append(f"--use-compress-program={compress_program}")
+    else:
+        args[0] = "-xa"
+    start_time = time.monotonic()
+    local["tar"](*args)
+    return time.monotonic() - start_time
+
+
+def modes(archive_path: str) -> List[Tuple[str, Optional[str]]]:
+    """:return: Decompressors available for archive along with tar's own
+        decompression.
+    """
+    found: List[Tuple[str, Optional[str]]] = [("tar", None)]
+    for decompressor in DECOMPRESSORS:
+        if not archive_path.endswith(decompressor.extension):
+            continue
+        try:
+            found.append((decompressor.name,
+                          find_decompressor(archive_path, decompressor.name)))
+        except GeniException:
+            continue
+    return found
+
+
+class BenchDecompress(cli.Application):
+    size = cli.SwitchAttr(["size"], str, default="256M",
+                          help="Size of files in the synthetic tarball")
+    repeat = cli.SwitchAttr(["repeat"], int, default=3,
+                            help="Extractions per mode, best one counts")
+
+    def main(self) -> int:  # pylint: disable=arguments-differ
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tar_path = os.path.join(temp_dir, "stage3.tar")
+            total = make_tarball(tar_path, parse_size(self.size))
+            print(f"Synthetic tarball: {total / 2**20:.0f} MiB of files, "
+                  f"{os.cpu_count()} CPUs")
+            print(f"{'archive':<16}{'mode':<10}{'seconds':>9}{'MiB/s':>9}")
+
+            for extension in COMPRESSORS:
+                archive_path = compress(tar_path, extension)
+                if archive_path is None:
+                    continue
+                for name, compress_program in modes(archive_path):
+                    elapsed = min(extract(archive_path,
+                                          os.path.join(temp_dir, "out"),
+                                          compress_program)
+                                  for _ in range(self.repeat))
+                    print(f"{os.path.basename(archive_path):<16}{name:<10}"
+                          f"{elapsed:>9.2f}{total / 2**20 / elapsed:>9.1f}")
+        return 0
+
+
+if __name__ == "__main__":
+    BenchDecompress.run()
@@ -49,12 +49,12 @@ setup(
     install_requires=[
         "arrow",
         "plumbum",
-        "portalocker",
         "requests",
     ],
     extras_require={
         "dev": ["mypy",
-                "pylint"],
+                "pylint",
+                "pytest"],
     },
     entry_points={
         "console_scripts": [
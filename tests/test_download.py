@@ -0,0 +1,224 @@
+"""Mirror ranking, ranged download, failover between mirrors and resume,
+against local HTTP servers standing in for mirrors.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+from typing import Iterator, List, Optional
+
+import pytest
+
+from geni.download import Downloader, DownloadError
+from geni.mirrors import rank_mirrors
+from geni.transport import Session, TransportConfig
+
+REMOTE_PATH = "/releases/stage3.tar.xz"
+CONTENT = random.Random(0).getrandbits(8 * 300000).to_bytes(300000, "little")
+SEGMENT_SIZE = 32 * 1024
+
+
+class Mirror(socketserver.ThreadingMixIn, HTTPServer):
+    """Serves `CONTENT` with ranges, misbehaving as told.
+
+    :ivar delay: Seconds to wait before responding.
+    :ivar truncate_at: Bytes of response body after which connection is
+        closed.
+    :ivar failing: Whether GET requests fail with 500.
+    :ivar fail_after: Number of GET requests after which they fail.
+    """
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), MirrorHandler)
+        self.delay = 0.0
+        self.truncate_at: Optional[int] = None
+        self.failing = False
+        self.fail_after: Optional[int] = None
+        self.served: List[range] = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def served_bytes(self) -> int:
+        with self.lock:
+            return sum(len(served) for served in self.served)
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            if self.fail_after is not None:
+                self.fail_after -= 1
+                return self.fail_after < 0
+            return self.failing
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: Mirror
+
+    def log_message(self, *_args) -> None:
+        pass
+
+    def _send_headers(self, status: int, start: int, end: int) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range",
+                             f"bytes {start}-{end - 1}/{len(CONTENT)}")
+        self.end_headers()
+
+    def do_HEAD(self) -> None:  # pylint: disable=invalid-name
+        time.sleep(self.server.delay)
+        self._send_headers(200, 0, len(CONTENT))
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        time.sleep(self.server.delay)
+        if self.server.should_fail():
+            self.send_error(500)
+            return
+
+        start, end, status = 0, len(CONTENT), 200
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2)) + 1
+            status = 206
+        self._send_headers(status, start, end)
+
+        if self.server.truncate_at is not None:
+            end = min(end, start + self.server.truncate_at)
+            self.close_connection = True
+        self.wfile.write(CONTENT[start:end])
+        with self.server.lock:
+            self.server.served.append(range(start, end))
+
+
+@pytest.fixture(autouse=True)
+def no_proxies(monkeypatch) -> None:
+    for var in list(os.environ):
+        if var.lower().endswith("_proxy"):
+            monkeypatch.delenv(var)
+
+
+def start_mirror() -> Mirror:
+    mirror = Mirror()
+    threading.Thread(target=mirror.serve_forever, daemon=True).start()
+    return mirror
+
+
+@pytest.fixture
+def mirrors() -> Iterator[List[Mirror]]:
+    started = [start_mirror() for _ in range(2)]
+    yield started
+    for mirror in started:
+        mirror.shutdown()
+        mirror.server_close()
+
+
+@pytest.fixture
+def dead_url() -> str:
+    """URL nobody listens on.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def make_downloader(urls: List[str], **kwargs) -> Downloader:
+    session = Session(TransportConfig(connect_timeout=1.0,
+                                      read_timeout=2.0,
+                                      retries=0))
+    return Downloader(urls,
+                      connections=4,
+                      segment_size=SEGMENT_SIZE,
+                      session=session,
+                      **kwargs)
+
+
+def download(downloader: Downloader, tmpdir) -> bytes:
+    local_path = str(tmpdir.join("stage3.tar.xz"))
+    consumed: List[bytes] = []
+    downloader.download_into(REMOTE_PATH, local_path, [consumed.append])
+    with open(local_path, "rb") as local_file:
+        content = local_file.read()
+    assert b"".join(consumed) == content
+    return content
+
+
+def test_rank_mirrors(mirrors, dead_url):
+    slow, fast = mirrors
+    slow.delay = 0.2
+    session = Session(TransportConfig(retries=0))
+
+    ranked = rank_mirrors(session,
+                          [dead_url, slow.url, fast.url],
+                          REMOTE_PATH,
+                          timeout=1.0)
+
+    assert ranked == [fast.url, slow.url, dead_url]
+
+
+def test_ranged_download_spread_over_mirrors(mirrors, tmpdir):
+    downloader = make_downloader([mirror.url for mirror in mirrors],
+                                 spread=2)
+
+    assert download(downloader, tmpdir) == CONTENT
+    assert all(mirror.served_bytes() > 0 for mirror in mirrors)
+
+
+def test_failover_from_dead_mirror(mirrors, dead_url, tmpdir):
+    failing, good = mirrors
+    failing.failing = True
+    downloader = make_downloader([dead_url, failing.url, good.url])
+
+    assert download(downloader, tmpdir) == CONTENT
+    assert good.served_bytes() == len(CONTENT)
+
+
+def test_failover_continues_segment(mirrors, tmpdir):
+    """Mirror cutting connections off serves the start of every segment,
+    the rest is taken over by the next mirror from the last chunk received.
+    """
+    truncating, good = mirrors
+    truncating.truncate_at = Downloader.CHUNK_SIZE + 1000
+    downloader = make_downloader([truncating.url, good.url])
+
+    assert download(downloader, tmpdir) == CONTENT
+    assert truncating.served_bytes() > 0
+    assert good.served_bytes() < len(CONTENT)
+
+
+def test_resume_interrupted_download(mirrors, tmpdir):
+    mirror = mirrors[0]
+    mirror.fail_after = 3
+    downloader = make_downloader([mirror.url])
+
+    with pytest.raises(DownloadError):
+        download(downloader, tmpdir)
+    assert tmpdir.join("stage3.tar.xz.part").exists()
+    assert tmpdir.join("stage3.tar.xz.part.ranges").exists()
+    served_before = mirror.served_bytes()
+
+    mirror.fail_after = None
+    assert download(downloader, tmpdir) == CONTENT
+    assert mirror.served_bytes() - served_before < len(CONTENT)
+    assert not tmpdir.join("stage3.tar.xz.part.ranges").exists()
+
+
+def test_journal_without_part_file_is_discarded(mirrors, tmpdir):
+    mirror = mirrors[0]
+    mirror.fail_after = 3
+    downloader = make_downloader([mirror.url])
+
+    with pytest.raises(DownloadError):
+        download(downloader, tmpdir)
+    tmpdir.join("stage3.tar.xz.part").remove()
+
+    mirror.fail_after = None
+    assert download(downloader, tmpdir) == CONTENT
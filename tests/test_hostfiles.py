@@ -0,0 +1,91 @@
+"""Host files put into chroot by sessions given different files.
+
+Commands are run by local shell instead of sudo, so it has to be run as
+root: `sudo python -m pytest tests`.
+"""
+import os
+import os.path
+
+from plumbum import local
+import pytest
+
+from geni import hostfiles
+from geni.hostfiles import HostFiles
+from geni.install import InstallManifest
+from geni.util import make_script
+
+pytestmark = pytest.mark.skipif(os.geteuid() != 0, reason="needs root")
+
+
+def run_script(commands):
+    local["sh"]["-e", "-c", make_script(commands)]()
+
+
+def write_file(path: str, content: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file_:
+        file_.write(content)
+
+
+def read_file(path: str) -> str:
+    with open(path, "r") as file_:
+        return file_.read()
+
+
+def list_files(base_dir: str):
+    return sorted(os.path.join(root, file_name)
+                  for root, _dirs, file_names in os.walk(base_dir)
+                  for file_name in file_names)
+
+
+@pytest.mark.parametrize("last_out", ["first", "joining"])
+def test_joining_session_keeps_chroot_original(tmpdir, monkeypatch,
+                                               last_out):
+    """Session joining with a file the first one wasn't given backs up
+    chroot's own file, which is put back whichever session leaves last.
+    """
+    monkeypatch.setattr(hostfiles, "sudo_script", run_script)
+    chroot_dir = str(tmpdir.join("chroot"))
+    resolv_conf = str(tmpdir.join("host", "resolv.conf"))
+    hosts = str(tmpdir.join("host", "hosts"))
+    write_file(resolv_conf, "host resolv.conf\n")
+    write_file(hosts, "host hosts\n")
+    manifest = InstallManifest(str(tmpdir.join("host_files.json")))
+    first = HostFiles(chroot_dir, [resolv_conf], manifest)
+    joining = HostFiles(chroot_dir, [resolv_conf, hosts], manifest)
+    chroot_hosts = joining.target_path(hosts)
+    write_file(chroot_hosts, "chroot hosts\n")
+
+    run_script(first.install_commands())
+    assert joining.missing() == [hosts]
+    run_script(joining.install_commands(joining.missing()))
+    assert read_file(chroot_hosts) == "host hosts\n"
+
+    last = first if last_out == "first" else joining
+    run_script(last.remove_commands())
+    last.forget()
+
+    assert read_file(chroot_hosts) == "chroot hosts\n"
+    assert list_files(chroot_dir) == [chroot_hosts]
+    assert manifest.load() == set()
+
+
+def test_killed_session_copy_is_not_backed_up(tmpdir, monkeypatch):
+    """Copy left in chroot by a session killed without removing it is
+    overwritten, not taken for chroot's own file.
+    """
+    monkeypatch.setattr(hostfiles, "sudo_script", run_script)
+    chroot_dir = str(tmpdir.join("chroot"))
+    resolv_conf = str(tmpdir.join("host", "resolv.conf"))
+    write_file(resolv_conf, "host resolv.conf\n")
+    manifest = InstallManifest(str(tmpdir.join("host_files.json")))
+    host_files = HostFiles(chroot_dir, [resolv_conf], manifest)
+
+    run_script(host_files.install_commands())
+    run_script(host_files.install_commands())
+    assert not os.path.lexists(host_files.target_path(resolv_conf)
+                               + hostfiles.BACKUP_SUFFIX)
+    run_script(host_files.remove_commands())
+    host_files.forget()
+
+    assert list_files(chroot_dir) == []
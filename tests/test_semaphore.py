@@ -0,0 +1,92 @@
+"""Stress test of `FileSemaphore` with hundreds of concurrent sessions,
+each in its own process, plus sessions of processes which crashed.
+
+Number of sessions can be changed with GENI_STRESS_SESSIONS, e.g.
+`GENI_STRESS_SESSIONS=1000 python -m pytest tests/test_semaphore.py`.
+"""
+import multiprocessing
+import os
+import random
+import time
+
+from geni.util import FileSemaphore
+
+SESSIONS = int(os.environ.get("GENI_STRESS_SESSIONS", "400"))
+
+
+def append_event(events_path: str, event: str) -> None:
+    with open(events_path, "a") as events_file:
+        events_file.write(f"{event}\n")
+
+
+def last_event(events_path: str) -> str:
+    with open(events_path, "r") as events_file:
+        return events_file.read().split()[-1]
+
+
+def run_session(sem_path: str, events_path: str, crash: bool) -> None:
+    semaphore = FileSemaphore(sem_path)
+    semaphore.up(on_first=lambda: append_event(events_path, "set_up"))
+    if last_event(events_path) != "set_up":
+        os._exit(2)  # pylint: disable=protected-access
+    if crash:
+        os._exit(0)  # pylint: disable=protected-access
+
+    time.sleep(random.uniform(0, 0.05))
+    semaphore.down(on_last=lambda: append_event(events_path, "tear_down"))
+    os._exit(0)  # pylint: disable=protected-access
+
+
+def run_sessions(sem_path: str, events_path: str, crashed: int) -> None:
+    processes = [
+        multiprocessing.Process(target=run_session,
+                                args=(sem_path, events_path, i < crashed))
+        for i in range(SESSIONS)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * SESSIONS
+
+
+def test_concurrent_sessions(tmpdir):
+    """Set up and tear down alternate, with every session in between, and
+    no sessions are left, including ones of crashed processes. Set up
+    follows set up only if sessions in crashed, leaving no one to tear
+    down.
+    """
+    sem_path = str(tmpdir.join("sem"))
+    events_path = str(tmpdir.join("events"))
+    open(events_path, "w").close()
+
+    start_time = time.monotonic()
+    crashed = 3
+    run_sessions(sem_path, events_path, crashed)
+    elapsed = time.monotonic() - start_time
+
+    assert FileSemaphore(sem_path).get() == 0
+    with open(events_path, "r") as events_file:
+        events = events_file.read().split()
+    assert events[0] == "set_up"
+    assert all(event != "tear_down" or previous == "set_up"
+               for previous, event in zip(events, events[1:]))
+    assert (events.count("set_up") - events.count("tear_down")
+            <= crashed)
+    print(f"{SESSIONS} sessions in {elapsed:.2f} s")
+
+
+def test_crashed_session_is_dropped(tmpdir):
+    """Session of crashed process doesn't keep the others from setting up
+    and tearing down.
+    """
+    sem_path = str(tmpdir.join("sem"))
+    semaphore = FileSemaphore(sem_path)
+    crashed = multiprocessing.Process(target=semaphore.up)
+    crashed.start()
+    crashed.join()
+
+    calls = []
+    assert semaphore.up(on_first=lambda: calls.append("set_up")) == 1
+    assert semaphore.down(on_last=lambda: calls.append("tear_down")) == 0
+    assert calls == ["set_up", "tear_down"]